@@ -0,0 +1,404 @@
+"""
+Offline load test for bot.py.
+
+Starts the real aiohttp app (bot.main_async) against a local Postgres,
+with fake Telegram Bot API and Gemini servers, replays synthetic webhook
+updates and Mini App submissions at a fixed rate and prints
+throughput / p50 / p95 / p99 / pool-wait.
+
+    BENCH_DATABASE_URL=postgresql://localhost/ai_bot_bench \
+        python bench.py --rate 50 --duration 30 --users 200 --gemini-latency 0.8
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import random
+import asyncio
+import hashlib
+import argparse
+from urllib.parse import urlencode
+
+from aiohttp import web, ClientSession, ClientTimeout
+
+BENCH_TOKEN = "123456:BENCH-TOKEN"
+
+
+# ============================================================
+# ✅ Stats
+# ============================================================
+class Series:
+    def __init__(self):
+        self.values: list[float] = []
+        self.errors = 0
+
+    def add(self, v: float):
+        self.values.append(v)
+
+    def pct(self, q: float) -> float:
+        if not self.values:
+            return 0.0
+        vals = sorted(self.values)
+        return vals[min(len(vals) - 1, int(q * len(vals)))]
+
+    def line(self, name: str, duration: float) -> str:
+        n = len(self.values)
+        return (
+            f"{name:<14} n={n:<6} err={self.errors:<4} rps={n / duration:7.1f}  "
+            f"p50={self.pct(0.50) * 1000:7.1f}ms  p95={self.pct(0.95) * 1000:7.1f}ms  "
+            f"p99={self.pct(0.99) * 1000:7.1f}ms  max={max(self.values, default=0) * 1000:7.1f}ms"
+        )
+
+
+STATS = {
+    "webhook": Series(),
+    "miniapp": Series(),
+    "reply_e2e": Series(),
+    "pool_wait": Series(),
+}
+PENDING_REPLIES: dict[int, list[float]] = {}
+GEMINI_CALLS = {"cached": 0, "inline": 0, "cache_miss": 0}
+
+
+# ============================================================
+# ✅ Fake Telegram Bot API
+# ============================================================
+async def _tg_params(request: web.Request) -> dict:
+    if request.content_type == "application/json":
+        return await request.json()
+    form = await request.post()
+    out = {}
+    for k, v in form.items():
+        try:
+            out[k] = json.loads(v)
+        except (TypeError, ValueError):
+            out[k] = v
+    return out
+
+
+def make_fake_telegram(latency: float) -> web.Application:
+    message_id = 0
+
+    async def handle(request: web.Request) -> web.Response:
+        nonlocal message_id
+        method = request.match_info["method"]
+        params = await _tg_params(request)
+        if latency:
+            await asyncio.sleep(latency)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Soffi", "username": "soffi_bench_bot",
+                      "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        elif method in ("sendMessage", "editMessageText"):
+            message_id += 1
+            chat_id = int(params.get("chat_id") or 0)
+            if method == "sendMessage":
+                waiting = PENDING_REPLIES.get(chat_id)
+                if waiting:
+                    STATS["reply_e2e"].add(time.monotonic() - waiting.pop(0))
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text") or ""}
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+# ============================================================
+# ✅ Fake Gemini
+# ============================================================
+def make_fake_gemini(latency: float, error_rate: float) -> web.Application:
+    answer = "Поняла Вас ✅ Подскажите, пожалуйста, какая главная цель на ближайший месяц?"
+    caches: dict[str, dict] = {}
+
+    def expire_time(ttl: str) -> str:
+        at = time.time() + float(ttl.rstrip("s") or 0)
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(at)) + ".123456789Z"
+
+    async def create_cache(request: web.Request) -> web.Response:
+        body = await request.json()
+        if not body.get("systemInstruction") or not body.get("model"):
+            return web.json_response({"error": {"code": 400, "message": "bad cachedContent"}}, status=400)
+        name = f"cachedContents/bench{len(caches) + 1}"
+        caches[name] = {
+            "name": name, "model": body["model"], "displayName": body.get("displayName", ""),
+            "expireTime": expire_time(body.get("ttl", "3600s")),
+        }
+        return web.json_response(caches[name])
+
+    async def list_caches(request: web.Request) -> web.Response:
+        return web.json_response({"cachedContents": list(caches.values())})
+
+    async def patch_cache(request: web.Request) -> web.Response:
+        name = f"cachedContents/{request.match_info['cache_id']}"
+        if name not in caches:
+            return web.json_response({"error": {"code": 404, "message": "CachedContent not found"}}, status=404)
+        caches[name]["expireTime"] = expire_time((await request.json()).get("ttl", "3600s"))
+        return web.json_response(caches[name])
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if request.match_info["action"] == "countTokens":
+            words = sum(len(p.get("text", "").split()) for c in body.get("contents", []) for p in c.get("parts", []))
+            return web.json_response({"totalTokens": words})
+        await asyncio.sleep(random.uniform(latency * 0.5, latency * 1.5))
+        if random.random() < error_rate:
+            return web.json_response({"error": {"code": 503}}, status=503)
+
+        # как настоящий API: cachedContent несовместим с systemInstruction, неизвестный кэш — 404
+        cached = body.get("cachedContent")
+        if cached and body.get("systemInstruction"):
+            return web.json_response({"error": {"code": 400, "message": "CachedContent can not be used with system_instruction"}}, status=400)
+        if cached and cached not in caches:
+            GEMINI_CALLS["cache_miss"] += 1
+            return web.json_response({"error": {"code": 404, "message": f"CachedContent not found: {cached}"}}, status=404)
+        GEMINI_CALLS["cached" if cached else "inline"] += 1
+
+        action = request.match_info["action"]
+        if action == "streamGenerateContent":
+            resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await resp.prepare(request)
+            for word in answer.split(" "):
+                chunk = {"candidates": [{"content": {"parts": [{"text": word + " "}]}}]}
+                await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+                await asyncio.sleep(0.01)
+            await resp.write_eof()
+            return resp
+
+        return web.json_response({"candidates": [{"content": {"role": "model", "parts": [{"text": answer}]}}]})
+
+    app = web.Application()
+    app.router.add_post("/v1beta/models/{model}:{action}", handle)
+    app.router.add_post("/v1beta/cachedContents", create_cache)
+    app.router.add_get("/v1beta/cachedContents", list_caches)
+    app.router.add_patch("/v1beta/cachedContents/{cache_id}", patch_cache)
+    return app
+
+
+# ============================================================
+# ✅ Synthetic traffic
+# ============================================================
+def sign_init_data(user: dict, bot_token: str) -> str:
+    data = {
+        "auth_date": str(int(time.time())),
+        "query_id": f"AAH{random.randint(10**8, 10**9)}",
+        "user": json.dumps(user, separators=(",", ":"), ensure_ascii=False),
+    }
+    check_string = "\n".join(f"{k}={data[k]}" for k in sorted(data))
+    secret = hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
+    data["hash"] = hmac.new(secret, check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+    return urlencode(data)
+
+
+def make_update(update_id: int, tg_id: int, text: str) -> dict:
+    msg = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": tg_id, "type": "private"},
+        "from": {"id": tg_id, "is_bot": False, "first_name": f"U{tg_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": msg}
+
+
+USER_TEXTS = ["Здравствуйте", "Какие у вас услуги?", "1", "Хочу больше заявок", "Сколько стоит?",
+              "Я владелец кофейни, нужен трафик", "около 1000$", "Спасибо"]
+
+
+async def fire_webhook(session: ClientSession, base: str, update_id: int, tg_id: int, text: str):
+    PENDING_REPLIES.setdefault(tg_id, []).append(time.monotonic())
+    t0 = time.monotonic()
+    try:
+        async with session.post(f"{base}/webhook", json=make_update(update_id, tg_id, text)) as r:
+            await r.read()
+            if r.status != 200:
+                STATS["webhook"].errors += 1
+                return
+    except Exception:
+        STATS["webhook"].errors += 1
+        return
+    STATS["webhook"].add(time.monotonic() - t0)
+
+
+async def fire_miniapp(session: ClientSession, base: str, tg_id: int):
+    user = {"id": tg_id, "first_name": f"U{tg_id}", "username": f"u{tg_id}"}
+    body = {
+        "initData": sign_init_data(user, BENCH_TOKEN),
+        "form": {"name": f"User {tg_id}", "niche": random.choice(["кофейня", "салон", "онлайн-школа"]), "contact": "@bench"},
+    }
+    t0 = time.monotonic()
+    try:
+        async with session.post(f"{base}/api/leads/miniapp", json=body) as r:
+            await r.read()
+            if r.status != 200:
+                STATS["miniapp"].errors += 1
+                return
+    except Exception:
+        STATS["miniapp"].errors += 1
+        return
+    STATS["miniapp"].add(time.monotonic() - t0)
+
+
+class TimedPool:
+    """
+    Обёртка над asyncpg.Pool: меряет время ожидания свободного соединения.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def acquire(self, **kwargs):
+        return _TimedAcquire(self._pool.acquire(**kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+class _TimedAcquire:
+    def __init__(self, ctx):
+        self._ctx = ctx
+
+    async def __aenter__(self):
+        t0 = time.monotonic()
+        conn = await self._ctx.__aenter__()
+        STATS["pool_wait"].add(time.monotonic() - t0)
+        return conn
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+
+# ============================================================
+# ✅ MAIN
+# ============================================================
+async def _start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def _wait_ready(session: ClientSession, base: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{base}/ready") as r:
+                if r.status == 200:
+                    return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("bot did not start")
+
+
+async def run(args):
+    tg_runner = await _start_site(make_fake_telegram(args.telegram_latency), args.telegram_port)
+    gm_runner = await _start_site(make_fake_gemini(args.gemini_latency, args.gemini_error_rate), args.gemini_port)
+
+    # env до импорта bot: модуль читает конфиг при импорте
+    os.environ.update({
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "GOOGLE_API_KEY": "bench",
+        "DATABASE_URL": args.database_url,
+        "PORT": str(args.port),
+        "RENDER_EXTERNAL_URL": f"http://127.0.0.1:{args.port}",
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{args.telegram_port}/bot",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{args.gemini_port}/v1beta",
+        "RATE_LIMIT_BACKEND": "memory",
+        "USER_MAX_REQUESTS_PER_DAY": str(10**9),
+        "REPORT_TASK_TOKEN": "bench",
+    })
+    os.environ.setdefault("GEMINI_STREAMING", "1" if args.streaming else "0")
+    # окно склейки добавило бы фиксированные ~1.5 с к каждому e2e; включается явно через env
+    os.environ.setdefault("COALESCE_WINDOW", "0")
+    # настоящий SYSTEM_PROMPT меньше минимума Gemini; порог снят, чтобы бенч проверял путь с кэшем
+    os.environ.setdefault("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "0")
+    import bot
+    bot.MAX_REQUESTS_PER_DAY = 10**9
+
+    bot_task = asyncio.create_task(bot.main_async())
+    base = f"http://127.0.0.1:{args.port}"
+    timeout = ClientTimeout(total=60)
+
+    async with ClientSession(timeout=timeout) as session:
+        await _wait_ready(session, base)
+        while bot.DB_POOL is None:
+            await asyncio.sleep(0.1)
+        bot.DB_POOL = TimedPool(bot.DB_POOL)
+        print(f"bot ready at {base}; running {args.duration}s at {args.rate} req/s", flush=True)
+
+        users = [10**9 + i for i in range(args.users)]
+        update_id = random.randint(10**6, 10**7)
+        tasks = []
+        t_start = time.monotonic()
+        n = 0
+        while time.monotonic() - t_start < args.duration:
+            tg_id = random.choice(users)
+            if random.random() < args.miniapp_share:
+                tasks.append(asyncio.create_task(fire_miniapp(session, base, tg_id)))
+            else:
+                update_id += 1
+                text = "/start" if random.random() < 0.05 else random.choice(USER_TEXTS)
+                tasks.append(asyncio.create_task(fire_webhook(session, base, update_id, tg_id, text)))
+            n += 1
+            # open-loop: следующий запрос по расписанию, а не после ответа
+            await asyncio.sleep(max(0.0, t_start + n / args.rate - time.monotonic()))
+
+        await asyncio.gather(*tasks)
+        await asyncio.sleep(args.drain)
+        duration = time.monotonic() - t_start
+
+        try:
+            async with session.get(f"{base}/webhook/stats", params={"token": "bench"}) as r:
+                queue_stats = await r.json()
+        except Exception:
+            queue_stats = {}
+
+    bot_task.cancel()
+    await asyncio.gather(bot_task, return_exceptions=True)
+    await tg_runner.cleanup()
+    await gm_runner.cleanup()
+
+    print()
+    for name, series in STATS.items():
+        print(series.line(name, duration))
+    lost = sum(len(v) for v in PENDING_REPLIES.values())
+    print(f"{'no_reply':<14} n={lost}")
+    print("gemini prompt:", json.dumps(GEMINI_CALLS))
+    if queue_stats:
+        print("webhook queue:", json.dumps(queue_stats, ensure_ascii=False))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline load test for bot.py")
+    ap.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL") or os.environ.get("DATABASE_URL"))
+    ap.add_argument("--rate", type=float, default=20.0, help="requests per second")
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds")
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--miniapp-share", type=float, default=0.1, help="fraction of Mini App submissions")
+    ap.add_argument("--gemini-latency", type=float, default=0.8)
+    ap.add_argument("--gemini-error-rate", type=float, default=0.0)
+    ap.add_argument("--telegram-latency", type=float, default=0.05)
+    ap.add_argument("--streaming", action="store_true")
+    ap.add_argument("--drain", type=float, default=5.0, help="seconds to wait for replies after load")
+    ap.add_argument("--port", type=int, default=18080)
+    ap.add_argument("--telegram-port", type=int, default=18081)
+    ap.add_argument("--gemini-port", type=int, default=18082)
+    args = ap.parse_args()
+
+    if not args.database_url:
+        sys.exit("Set BENCH_DATABASE_URL (local Postgres) or --database-url")
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
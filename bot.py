@@ -1,18 +1,34 @@
 import os
+import signal
 import asyncio
-import requests
+import functools
 import json
+import random
+import re
 import hmac
+import base64
+import csv
 import hashlib
-from datetime import datetime, timezone
+import io
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
 from urllib.parse import parse_qsl
+import aiohttp
 from aiohttp import web
 
 import asyncpg
 
 from telegram import Update
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.constants import ChatAction
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
+from telegram.ext import (
+    Application, BasePersistence, CommandHandler, MessageHandler, PersistenceInput, filters, ContextTypes,
+)
 
 # ============================================================
 # ✅ BUILD TAG (check deploy via /version)
@@ -30,10 +46,42 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 
 BOT_USERNAME = os.environ.get("BOT_USERNAME")  # bot username without "@"
 REPORT_TASK_TOKEN = os.environ.get("REPORT_TASK_TOKEN")
+REPORT_MAX_DAYS = int(os.environ.get("REPORT_MAX_DAYS", "3660"))  # потолок для "<N>d" в /report, /export
 BASE_URL = os.environ.get("RENDER_EXTERNAL_URL", "https://ai-bot-a3aj.onrender.com").rstrip("/")
 
 OWNER_LIVE_FEED = os.environ.get("OWNER_LIVE_FEED", "0") == "1"
 
+# Mini App auth: свежесть initData и короткоживущие сессионные токены
+WEBAPP_AUTH_MAX_AGE = int(os.environ.get("WEBAPP_AUTH_MAX_AGE", "86400"))
+WEBAPP_SESSION_TTL = int(os.environ.get("WEBAPP_SESSION_TTL", "3600"))
+WEBAPP_AUTH_CACHE_MAX = int(os.environ.get("WEBAPP_AUTH_CACHE_MAX", "5000"))
+SESSION_SECRET = os.environ.get("SESSION_SECRET")  # default: derived from TELEGRAM_TOKEN
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # optional: /metrics?token=... or Bearer
+
+# локальные стенды (bench.py): подмена Bot API, например http://127.0.0.1:8081/bot
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL")
+
+# fast-ack webhook: ответ Telegram сразу, обработка — в пуле воркеров
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # optional, X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_FAST_ACK = os.environ.get("WEBHOOK_FAST_ACK", "1") == "1"
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_MAX = int(os.environ.get("WEBHOOK_QUEUE_MAX", "1000"))
+WEBHOOK_DEDUP_MAX = int(os.environ.get("WEBHOOK_DEDUP_MAX", "10000"))
+# setWebhook только если URL изменился; =1 — принудительно (например, после смены WEBHOOK_SECRET)
+WEBHOOK_FORCE_RESET = os.environ.get("WEBHOOK_FORCE_RESET", "0") == "1"
+
+# холодный старт: /health отвечает сразу, остальное ждёт готовности до READY_WAIT_TIMEOUT сек
+READY_WAIT_TIMEOUT = float(os.environ.get("READY_WAIT_TIMEOUT", "10"))
+READY_GATED_PATHS = ("/webhook", "/api/", "/tasks/")
+
+# multi-process: front-процесс принимает HTTP и раздаёт апдейты по hash(chat_id) N воркерам
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "1"))
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if os.environ.get("WORKER_INDEX") else None
+WORKER_SOCKET_DIR = os.environ.get("WORKER_SOCKET_DIR", "/tmp")
+MULTI_PROCESS = WORKER_PROCESSES > 1
+IS_PRIMARY = WORKER_INDEX in (None, 0)  # фоновые singleton-задачи и webhook — только здесь
+
 # ============================================================
 # ✅ CORS
 # ============================================================
@@ -46,6 +94,37 @@ ALLOWED_ORIGINS = {
 # ✅ GEMINI
 # ============================================================
 MODEL = "gemini-2.5-flash"
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "16"))
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "20"))
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "2"))
+
+# пул ключей и моделей: первая модель — основная, остальные — запасные
+GEMINI_API_KEYS = [k.strip() for k in os.environ.get("GEMINI_API_KEYS", "").split(",") if k.strip()] or (
+    [GOOGLE_API_KEY] if GOOGLE_API_KEY else []
+)
+GEMINI_MODELS = [m.strip() for m in os.environ.get("GEMINI_MODELS", f"{MODEL},gemini-2.5-flash-lite").split(",") if m.strip()]
+GEMINI_KEY_RPM = int(os.environ.get("GEMINI_KEY_RPM", "0"))  # локальный потолок на ключ+модель, 0 — без потолка
+GEMINI_KEY_RPD = int(os.environ.get("GEMINI_KEY_RPD", "0"))
+GEMINI_429_COOLDOWN = float(os.environ.get("GEMINI_429_COOLDOWN", "60"))  # если Gemini не сказал retryDelay
+# суточная квота сбрасывается по тихоокеанскому времени — не ждём её, а перепроверяем маршрут не реже раза в час
+GEMINI_DAILY_429_PROBE = float(os.environ.get("GEMINI_DAILY_429_PROBE", "3600"))
+GEMINI_BREAKER_FAILURES = int(os.environ.get("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.environ.get("GEMINI_BREAKER_COOLDOWN", "30"))
+GEMINI_BREAKER_COOLDOWN_MAX = float(os.environ.get("GEMINI_BREAKER_COOLDOWN_MAX", "600"))
+
+# cachedContents: SYSTEM_PROMPT регистрируется один раз на ключ+модель и дальше передаётся ссылкой
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "1") == "1"
+GEMINI_CONTEXT_CACHE_TTL = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+GEMINI_CONTEXT_CACHE_REFRESH = float(os.environ.get("GEMINI_CONTEXT_CACHE_REFRESH", "600"))  # продлеваем заранее
+# минимальный размер явного кэша у Gemini (2.5 Flash — 1024 токена); меньше — кэш не создаём вовсе
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+
+# streamGenerateContent + постепенное редактирование сообщения в Telegram
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))
+TG_MAX_MESSAGE_LEN = 4096
 
 SYSTEM_PROMPT = (
     "Ты — Soffi, дружелюбный и общительный AI-ассистент AWM OS.\n"
@@ -108,15 +187,352 @@ POST_MINIAPP_TEXT = (
     "Если не уверены — напишите коротко цель, и я подберу сама."
 )
 
+# ✅ Фиксированные шаги воронки (отвечаем локально, без Gemini)
+SERVICES = {
+    1: ("AI-Маркетинг Автопилот", "month"),
+    2: ("Content & Ads Turbo", "month"),
+    3: ("Разработка экосистемы", "once"),
+    4: ("Глубокий AI-аудит", "once"),
+}
+
+SERVICE_GOAL_QUESTIONS = {
+    1: "Какая главная цель на ближайшие 2–3 месяца: больше заявок, рост узнаваемости или стабильный контент без Вашего участия?",
+    2: "Какая главная цель рекламы: заявки и продажи, подписчики или тест новых креативов?",
+    3: "Что для Вас сейчас главное: сайт, Telegram Mini App или интеграции (CRM, оплаты, боты)?",
+    4: "Что сейчас беспокоит сильнее всего: мало заявок, дорогая реклама или низкая конверсия в продажу?",
+}
+
+BUDGET_QUESTIONS = {
+    "month": "На какую сумму Вы рассчитываете в месяц?",
+    "once": "На какую сумму Вы рассчитываете разово?",
+}
+
+FINAL_TEXT = (
+    "Отлично, зафиксировала ✅ Мы на финальной стадии разработки и готовим запуск.\n"
+    "Как только будет старт и условия — я напишу Вам здесь первой.\n\n"
+    "Я могу быть Вам ещё полезной?"
+)
+
 # ============================================================
 # ✅ LIMITS / MEMORY
 # ============================================================
 MAX_TURNS = 12
 MAX_REQUESTS_PER_DAY = 200
-GLOBAL_LIMIT = {"date": None, "count": 0, "blocked_date": None}
+USER_MAX_REQUESTS_PER_DAY = int(os.environ.get("USER_MAX_REQUESTS_PER_DAY", "40"))
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "postgres")  # postgres | memory
+if MULTI_PROCESS:
+    RATE_LIMIT_BACKEND = "postgres"  # дневные лимиты общие на все процессы
+RATE_LEASE_GLOBAL = int(os.environ.get("RATE_LEASE_GLOBAL", "5"))
+RATE_LEASE_USER = int(os.environ.get("RATE_LEASE_USER", "3"))
+RATE_LEASE_TTL = float(os.environ.get("RATE_LEASE_TTL", "60"))
+LIMIT_REACHED_TEXT = "⚠️ Лимит на сегодня исчерпан. Попробуйте завтра."
+USER_LIMIT_REACHED_TEXT = "⚠️ Вы очень активны сегодня 🙂 Давайте продолжим чуть позже."
+GEMINI_BUSY_TEXT = "⚠️ Сейчас очень много запросов. Попробуйте ещё раз через минуту."
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500"))
+SUMMARY_MAX_CHARS = int(os.environ.get("SUMMARY_MAX_CHARS", "1200"))
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get("PERSISTENCE_UPDATE_INTERVAL", "30"))
+# сообщения подряд склеиваются в один ход: тишина COALESCE_WINDOW сек, но не дольше COALESCE_MAX_WAIT; 0 — выкл
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "1.5"))
+COALESCE_MAX_WAIT = float(os.environ.get("COALESCE_MAX_WAIT", "6"))
+TYPING_REFRESH = 4.0  # «печатает…» в Telegram гаснет через ~5 с
 
 tg_app: Application | None = None
 DB_POOL: asyncpg.Pool | None = None
+HTTP_SESSION: aiohttp.ClientSession | None = None
+GEMINI_SEM: asyncio.Semaphore | None = None
+APP_READY = asyncio.Event()
+STARTUP_STAGE = "boot"
+
+# write-behind лог: messages / lead_events пишутся пачками фоновой задачей
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", "10000"))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_RETRY_MAX_DELAY = float(os.environ.get("LOG_RETRY_MAX_DELAY", "30"))  # потолок паузы между повторами COPY
+LOG_STOP_RETRIES = int(os.environ.get("LOG_STOP_RETRIES", "3"))  # при остановке не висим на лежащей БД вечно
+LOG_QUEUE: asyncio.Queue | None = None
+LOG_WRITER_TASK: asyncio.Task | None = None
+
+# webhook worker pool: очередь на воркер, чат всегда попадает в один и тот же воркер
+WEBHOOK_QUEUES: list[asyncio.Queue] = []
+WEBHOOK_WORKER_TASKS: list[asyncio.Task] = []
+WEBHOOK_SEEN: "OrderedDict[int, None]" = OrderedDict()
+WEBHOOK_STATS = {"received": 0, "duplicates": 0, "processed": 0, "failed": 0, "lag_last": 0.0, "lag_max": 0.0}
+
+# outbox: подтверждения после Mini App отправляются фоном с ретраями
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_BATCH = int(os.environ.get("OUTBOX_BATCH", "20"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_WAKEUP: asyncio.Event | None = None
+OUTBOX_TASK: asyncio.Task | None = None
+
+# помесячные партиции messages / lead_events + удаление старых
+# удаление по сроку — только явно: RETENTION_MONTHS=12 и т.п.; по умолчанию (0) хранится всё
+RETENTION_MONTHS = int(os.environ.get("RETENTION_MONTHS", "0"))
+PARTITION_MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", "2"))
+DB_MAINTENANCE_INTERVAL = float(os.environ.get("DB_MAINTENANCE_INTERVAL", str(6 * 3600)))
+DB_MAINTENANCE_TASK: asyncio.Task | None = None
+FORGET_BATCH = int(os.environ.get("FORGET_BATCH", "100"))
+FORGET_TASKS: set[asyncio.Task] = set()
+
+# выгрузки CSV: серверный курсор -> чанки; в Telegram — частями не больше EXPORT_PART_BYTES
+EXPORT_PREFETCH = int(os.environ.get("EXPORT_PREFETCH", "1000"))
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_PART_BYTES = int(os.environ.get("EXPORT_PART_BYTES", str(20 * 1024 * 1024)))
+EXPORT_TASKS: set[asyncio.Task] = set()
+
+# полнотекстовый поиск по messages (tsvector 'russian' + GIN)
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "10"))
+SEARCH_MAX_HITS = int(os.environ.get("SEARCH_MAX_HITS", "20000"))  # потолок совпадений для ранжирования
+
+# рассылка: лимиты Telegram ~30 msg/s глобально, ~1 msg/s в один чат
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_PER_CHAT_RATE = float(os.environ.get("BROADCAST_PER_CHAT_RATE", "1"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PROGRESS_EVERY = float(os.environ.get("BROADCAST_PROGRESS_EVERY", "30"))
+BROADCAST_TASK: asyncio.Task | None = None
+BROADCAST_SHUTTING_DOWN = False
+
+# initData, уже прошедшие проверку: sha256(initData) -> (valid_until, parsed)
+WEBAPP_AUTH_CACHE: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+
+# кэш профиля (имя/ниша из Mini App + ниша из users): LRU + TTL
+PROFILE_CACHE_MAX = int(os.environ.get("PROFILE_CACHE_MAX", "10000"))
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "600"))
+PROFILE_CACHE: "OrderedDict[int, tuple[float, tuple[str | None, str | None, str | None]]]" = OrderedDict()
+
+# кэш ответов Gemini на типовые короткие реплики
+RESPONSE_CACHE_MAX = int(os.environ.get("RESPONSE_CACHE_MAX", "2000"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", str(6 * 3600)))
+RESPONSE_CACHE_MAX_TEXT = int(os.environ.get("RESPONSE_CACHE_MAX_TEXT", "80"))
+RESPONSE_CACHE_MAX_TURN = int(os.environ.get("RESPONSE_CACHE_MAX_TURN", "3"))
+RESPONSE_CACHE_PG = os.environ.get("RESPONSE_CACHE_PG", "0") == "1"
+RESPONSE_CACHE: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+RESPONSE_CACHE_STATS = {"hits": 0, "misses": 0, "stores": 0, "saved_seconds": 0.0, "gemini_latency_avg": 0.0}
+
+# воронка для /report: порядок этапов = порядок конверсии
+FUNNEL_STAGES = ("start", "miniapp_submit", "message", "budget")
+
+MESSAGES_COLUMNS = ("tg_id", "direction", "text", "created_at")
+LEAD_EVENTS_COLUMNS = ("tg_id", "lead_id", "event", "source", "meta", "created_at")
+
+
+# ============================================================
+# ✅ Metrics (Prometheus text format, без внешних зависимостей)
+# ============================================================
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for lv, v in self._values.items():
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {v}")
+        return out
+
+
+class Gauge:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, *labelvalues):
+        self._values[labelvalues] = float(value)
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def dec(self, *labelvalues, amount: float = 1.0):
+        self.inc(*labelvalues, amount=-amount)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge"]
+        for lv, v in self._values.items():
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {v}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._values: dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *labelvalues):
+        row = self._values.get(labelvalues)
+        if row is None:
+            row = self._values[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+        for idx, le in enumerate(self.buckets):
+            if value <= le:
+                row[idx] += 1
+                break
+        row[-2] += value
+        row[-1] += 1
+
+    @asynccontextmanager
+    async def time(self, *labelvalues):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labelvalues)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for lv, row in self._values.items():
+            acc = 0
+            for idx, le in enumerate(self.buckets):
+                acc += row[idx]
+                le_label = 'le="%s"' % le
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, le_label)} {acc}")
+            inf_label = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, inf_label)} {row[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {row[-2]}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {row[-1]}")
+        return out
+
+
+CALL_SECONDS = Histogram("bot_call_seconds", "Latency of instrumented calls (Gemini, DB helpers)", ("fn",))
+CALL_ERRORS = Counter("bot_call_errors_total", "Exceptions raised by instrumented calls", ("fn",))
+TELEGRAM_SECONDS = Histogram("bot_telegram_api_seconds", "Telegram Bot API request latency", ("method",))
+HTTP_SECONDS = Histogram("bot_http_request_seconds", "aiohttp request latency", ("route", "method", "status"))
+WEBHOOK_UPDATE_SECONDS = Histogram("bot_webhook_update_seconds", "process_update time per update type", ("type",))
+GEMINI_ERRORS = Counter("bot_gemini_errors_total", "Gemini errors by kind", ("kind",))
+DB_POOL_WAIT_SECONDS = Histogram("bot_db_pool_wait_seconds", "Time spent waiting for a pool connection")
+DB_POOL_WAITING = Gauge("bot_db_pool_waiting", "Coroutines currently waiting for a pool connection")
+DB_POOL_IN_USE = Gauge("bot_db_pool_in_use", "Pool connections currently in use")
+DB_POOL_SIZE = Gauge("bot_db_pool_size", "Pool connections open")
+RATE_REMAINING = Gauge("bot_daily_limit_remaining", "Remaining global Gemini quota (token bucket)")
+GEMINI_ROUTE_STATE = Gauge(
+    "bot_gemini_route_state", "0 closed, 1 half-open, 2 open, 3 rate-limited", ("key", "model")
+)
+GEMINI_ROUTE_REQUESTS = Counter(
+    "bot_gemini_route_requests_total", "Gemini calls per key/model by outcome", ("key", "model", "outcome")
+)
+WEBHOOK_QUEUE_DEPTH = Gauge("bot_webhook_queue_depth", "Updates waiting in webhook worker queues")
+WEBHOOK_LAG = Gauge("bot_webhook_lag_seconds", "Queue lag of the last processed update")
+RESPONSE_CACHE_EVENTS = Gauge("bot_response_cache", "Response cache counters", ("kind",))
+MESSAGES_COALESCED = Counter("bot_messages_coalesced_total", "Messages merged into an earlier pending turn")
+GEMINI_PROMPT_MODE = Counter("bot_gemini_prompt_total", "Gemini calls by system prompt delivery", ("mode",))
+
+METRICS = [
+    CALL_SECONDS, CALL_ERRORS, TELEGRAM_SECONDS, HTTP_SECONDS, WEBHOOK_UPDATE_SECONDS, GEMINI_ERRORS,
+    DB_POOL_WAIT_SECONDS, DB_POOL_WAITING, DB_POOL_IN_USE, DB_POOL_SIZE, RATE_REMAINING,
+    GEMINI_ROUTE_STATE, GEMINI_ROUTE_REQUESTS, WEBHOOK_QUEUE_DEPTH, WEBHOOK_LAG, RESPONSE_CACHE_EVENTS,
+    MESSAGES_COALESCED, GEMINI_PROMPT_MODE,
+]
+
+
+def instrumented(fn):
+    """
+    Декоратор для async-функций: латентность и ошибки в bot_call_seconds{fn=...}.
+    """
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            CALL_ERRORS.inc(name)
+            raise
+        finally:
+            CALL_SECONDS.observe(time.perf_counter() - t0, name)
+
+    return wrapper
+
+
+@asynccontextmanager
+async def db_acquire():
+    """
+    DB_POOL.acquire() с учётом ожидания: bot_db_pool_wait_seconds / bot_db_pool_waiting.
+    """
+    DB_POOL_WAITING.inc()
+    t0 = time.perf_counter()
+    try:
+        ctx = DB_POOL.acquire()
+        conn = await ctx.__aenter__()
+    finally:
+        DB_POOL_WAITING.dec()
+    DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - t0)
+    try:
+        yield conn
+    except BaseException as e:
+        await ctx.__aexit__(type(e), e, e.__traceback__)
+        raise
+    else:
+        await ctx.__aexit__(None, None, None)
+
+
+def _update_type(data: dict) -> str:
+    for key in data:
+        if key == "update_id":
+            continue
+        if key == "message" and str((data[key] or {}).get("text") or "").startswith("/"):
+            return "command"
+        return key
+    return "unknown"
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest с латентностью каждого вызова Bot API (sendMessage, editMessageText, ...).
+    """
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        async with TELEGRAM_SECONDS.time(url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, request_data=request_data, **kwargs)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else "unmatched"
+        HTTP_SECONDS.observe(time.perf_counter() - t0, route, request.method, status)
+
+
+@web.middleware
+async def readiness_middleware(request, handler):
+    """
+    Пока идёт старт, запросы к webhook/API ждут готовности; не дождались — 503.
+    Telegram повторит доставку сам, так что апдейты не теряются.
+    """
+    if not APP_READY.is_set() and request.path.startswith(READY_GATED_PATHS):
+        try:
+            await asyncio.wait_for(APP_READY.wait(), READY_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return web.json_response(
+                {"ok": False, "error": "starting", "stage": STARTUP_STAGE},
+                status=503,
+                headers={"Retry-After": "2"},
+            )
+    return await handler(request)
 
 
 # ============================================================
@@ -134,31 +550,518 @@ async def cors_middleware(request, handler):
         resp.headers["Access-Control-Allow-Origin"] = origin
         resp.headers["Vary"] = "Origin"
         resp.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS, GET"
-        resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-Task-Token"
+        resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-Task-Token, Authorization"
     return resp
 
 
 # ============================================================
-# ✅ Helpers
+# ✅ Gemini routing (keys × models)
 # ============================================================
-def ask_gemini(contents: list[dict]) -> str:
-    if not GOOGLE_API_KEY:
-        raise RuntimeError("Missing GOOGLE_API_KEY")
+class GeminiUnavailableError(RuntimeError):
+    """Ни одна пара ключ/модель сейчас не доступна (429 / брейкер)."""
 
-    endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL}:generateContent"
-    payload = {
-        "systemInstruction": {"parts": [{"text": SYSTEM_PROMPT}]},
+    def __init__(self, retry_in: float):
+        super().__init__(f"no Gemini route available, retry in ~{retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class GeminiRoute:
+    """
+    Пара API-ключ + модель: своя квота (минута/сутки), EWMA ошибок и
+    circuit breaker closed -> open -> half_open (одна пробная заявка) -> closed.
+    429 брейкер не трогает — маршрут просто «остывает» до retryDelay.
+    """
+
+    def __init__(self, key_index: int, key: str, model: str, model_rank: int):
+        self.key_label = f"k{key_index}"
+        self.key = key
+        self.model = model
+        self.model_rank = model_rank
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = GEMINI_BREAKER_COOLDOWN
+        self.probing = False
+        self.limited_until = 0.0
+        self.error_rate = 0.0
+        self.inflight = 0
+        self.minute_start = 0.0
+        self.minute_used = 0
+        self.day: date | None = None
+        self.day_used = 0
+
+    def _roll(self, now: float):
+        if now - self.minute_start >= 60:
+            self.minute_start = now
+            self.minute_used = 0
+        today = datetime.now(timezone.utc).date()
+        if self.day != today:
+            self.day = today
+            self.day_used = 0
+
+    def retry_in(self, now: float) -> float:
+        self._roll(now)
+        waits = [self.limited_until - now]
+        if self.state == "open":
+            waits.append(self.open_until - now)
+        if GEMINI_KEY_RPM and self.minute_used >= GEMINI_KEY_RPM:
+            waits.append(self.minute_start + 60 - now)
+        if GEMINI_KEY_RPD and self.day_used >= GEMINI_KEY_RPD:
+            # локальный суточный счётчик обнуляется в полночь UTC (см. _roll)
+            utc_now = datetime.now(timezone.utc)
+            midnight = datetime(utc_now.year, utc_now.month, utc_now.day, tzinfo=timezone.utc) + timedelta(days=1)
+            waits.append((midnight - utc_now).total_seconds())
+        return max(0.0, *waits)
+
+    def available(self, now: float) -> bool:
+        self._roll(now)
+        if now < self.limited_until:
+            return False
+        if GEMINI_KEY_RPM and self.minute_used >= GEMINI_KEY_RPM:
+            return False
+        if GEMINI_KEY_RPD and self.day_used >= GEMINI_KEY_RPD:
+            return False
+        if self.state == "open":
+            if now < self.open_until:
+                return False
+            self.state = "half_open"
+        return not (self.state == "half_open" and self.probing)
+
+    def begin(self, count: bool = True):
+        # count=False — повтор того же логического вызова (кэш отклонён), квоту он уже учёл
+        self.inflight += 1
+        if count:
+            self.minute_used += 1
+            self.day_used += 1
+        if self.state == "half_open":
+            self.probing = True
+
+    def _end(self, outcome: str):
+        self.inflight = max(0, self.inflight - 1)
+        self.probing = False
+        GEMINI_ROUTE_REQUESTS.inc(self.key_label, self.model, outcome)
+
+    def success(self):
+        self._end("ok")
+        self.error_rate *= 0.9
+        if self.state != "closed":
+            print(f"✅ Gemini route {self.key_label}/{self.model} closed again", flush=True)
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = GEMINI_BREAKER_COOLDOWN
+
+    def failure(self, outcome: str = "error"):
+        # outcome — причина для метрики: 5xx / timeout / network
+        self._end(outcome)
+        self.error_rate = self.error_rate * 0.9 + 0.1
+        self.failures += 1
+        if self.state == "half_open":
+            self.cooldown = min(self.cooldown * 2, GEMINI_BREAKER_COOLDOWN_MAX)
+            self._open(self.cooldown)
+        elif self.failures >= GEMINI_BREAKER_FAILURES:
+            self._open(self.cooldown)
+
+    def disable(self):
+        # 401/403/404: ключ отозван или модели нет — надолго, но с пробой
+        self._end("rejected")
+        self._open(GEMINI_BREAKER_COOLDOWN_MAX)
+
+    def rate_limited(self, seconds: float):
+        self._end("429")
+        self.limited_until = max(self.limited_until, time.monotonic() + seconds)
+
+    def release(self, outcome: str = "bad_request"):
+        # 400 и т.п.: проблема в запросе, а не в ключе; брейкер не трогаем
+        self._end(outcome)
+
+    def cache_rejected(self):
+        # кэш истёк/удалён — не ошибка ключа и не плохой запрос, сразу повторяем inline
+        self._end("cache_rejected")
+
+    def _open(self, seconds: float):
+        self.state = "open"
+        self.open_until = time.monotonic() + seconds
+        print(f"Gemini route {self.key_label}/{self.model} open for {seconds:.0f}s", flush=True)
+
+
+class GeminiRouter:
+    """
+    Выбор маршрута: основная модель раньше запасной; внутри модели —
+    сначала half-open пробы (чтобы ключ быстрее вернулся в ротацию),
+    потом меньше ошибок, меньше запросов в полёте и в текущей минуте.
+    """
+
+    def __init__(self, keys: list[str], models: list[str]):
+        self.routes = [
+            GeminiRoute(i, key, model, rank)
+            for rank, model in enumerate(models)
+            for i, key in enumerate(keys)
+        ]
+
+    def pick(self, avoid: set) -> GeminiRoute | None:
+        now = time.monotonic()
+        ready = [r for r in self.routes if r.available(now)]
+        candidates = [r for r in ready if r not in avoid] or ready
+        if not candidates:
+            return None
+        route = min(candidates, key=lambda r: (
+            r.model_rank, r.state != "half_open", round(r.error_rate, 2), r.inflight, r.minute_used,
+        ))
+        route.begin()
+        return route
+
+    def retry_in(self) -> float:
+        now = time.monotonic()
+        return min((r.retry_in(now) for r in self.routes), default=GEMINI_429_COOLDOWN)
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        out = []
+        for r in self.routes:
+            r.available(now)  # open -> half_open по таймеру
+            state = "rate_limited" if now < r.limited_until else r.state
+            out.append({
+                "key": r.key_label, "model": r.model, "state": state,
+                "retry_in": r.retry_in(now), "error_rate": round(r.error_rate, 3),
+                "minute_used": r.minute_used, "day_used": r.day_used,
+            })
+        return out
+
+
+GEMINI_ROUTER = GeminiRouter(GEMINI_API_KEYS, GEMINI_MODELS)
+
+_RETRY_DELAY_RE = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+
+def _parse_rate_limit(body: str, retry_after: str | None) -> float:
+    """
+    Сколько «остывать» маршруту после 429: RetryInfo.retryDelay / Retry-After.
+    Суточная квота (quotaId ...PerDay...) без retryDelay паркует маршрут
+    на GEMINI_DAILY_429_PROBE, после чего следующий запрос станет пробой.
+    """
+    m = _RETRY_DELAY_RE.search(body)
+    if m:
+        return max(1.0, float(m.group(1)))
+    if "PerDay" in body:
+        return GEMINI_DAILY_429_PROBE
+    if retry_after and retry_after.isdigit():
+        return max(1.0, float(retry_after))
+    return GEMINI_429_COOLDOWN
+
+
+def _route_verdict(route: GeminiRoute, status: int, body: str, retry_after: str | None) -> str:
+    """
+    Учитывает ответ в маршруте и говорит, что делать дальше:
+    switch — сразу другой маршрут, retry — пауза и повтор, fail — ошибка наверх.
+    """
+    if status == 429:
+        GEMINI_ERRORS.inc("429")
+        route.rate_limited(_parse_rate_limit(body, retry_after))
+        return "switch"
+    if status >= 500:
+        GEMINI_ERRORS.inc("5xx")
+        route.failure("5xx")
+        return "retry"
+    GEMINI_ERRORS.inc("http")
+    if status in (401, 403, 404):
+        route.disable()
+        return "switch"
+    route.release()
+    return "fail"
+
+
+# ============================================================
+# ✅ Gemini context cache (SYSTEM_PROMPT)
+# ============================================================
+CONTEXT_CACHES: dict[tuple[str, str], dict] = {}  # (key_label, model) -> {"name", "expires_at"}
+CONTEXT_CACHE_RETRY_AT: dict[tuple[str, str], float] = {}
+CONTEXT_CACHE_BUSY: set[tuple[str, str]] = set()
+CONTEXT_CACHE_TASK: asyncio.Task | None = None
+CONTEXT_CACHE_DISABLED: set[str] = set()  # теги (хэш промпта+модели), которые кэшировать нельзя
+_EXPIRE_FRACTION_RE = re.compile(r"\.\d+")
+
+
+def _context_cache_tag(model: str) -> str:
+    # displayName = хэш промпта и модели: соседние воркеры и рестарты находят тот же кэш
+    digest = hashlib.sha256(f"{model}\n{SYSTEM_PROMPT}".encode("utf-8")).hexdigest()[:16]
+    return f"soffi-system-{digest}"
+
+
+def _context_cache_entry(obj: dict) -> dict:
+    raw = _EXPIRE_FRACTION_RE.sub("", obj.get("expireTime") or "").replace("Z", "+00:00")
+    try:
+        expires_at = datetime.fromisoformat(raw).timestamp()
+    except ValueError:
+        expires_at = time.time() + GEMINI_CONTEXT_CACHE_TTL
+    return {"name": obj["name"], "expires_at": expires_at}
+
+
+def context_cache_name(route: GeminiRoute) -> str | None:
+    """
+    Имя живого cachedContents для маршрута или None (тогда промпт идёт inline).
+    Отсутствующий кэш создаётся в фоне — запрос его не ждёт.
+    """
+    if not GEMINI_CONTEXT_CACHE or _context_cache_tag(route.model) in CONTEXT_CACHE_DISABLED:
+        return None
+    entry = CONTEXT_CACHES.get((route.key_label, route.model))
+    if entry is not None and entry["expires_at"] - time.time() > 30:
+        return entry["name"]
+    _schedule_context_cache(route)
+    return None
+
+
+def _context_cache_rejected(route: GeminiRoute, status: int, body: str) -> bool:
+    # кэш удалили/истёк раньше срока: забываем его и сразу повторяем inline
+    if status not in (400, 403, 404) or "cachedcontent" not in body.lower():
+        return False
+    print(f"context cache rejected for {route.key_label}/{route.model}: HTTP {status}", flush=True)
+    CONTEXT_CACHES.pop((route.key_label, route.model), None)
+    _schedule_context_cache(route)
+    return True
+
+
+def _schedule_context_cache(route: GeminiRoute):
+    k = (route.key_label, route.model)
+    if k in CONTEXT_CACHE_BUSY or time.monotonic() < CONTEXT_CACHE_RETRY_AT.get(k, 0.0):
+        return
+    CONTEXT_CACHE_BUSY.add(k)
+    task = asyncio.create_task(_ensure_context_cache(route))
+    task.add_done_callback(lambda _: CONTEXT_CACHE_BUSY.discard(k))
+
+
+async def _context_cache_call(route: GeminiRoute, method: str, path: str, **kwargs) -> tuple[int, dict]:
+    session = _get_http_session()
+    params = {"key": route.key, **kwargs.pop("params", {})}
+    timeout = aiohttp.ClientTimeout(total=GEMINI_TIMEOUT)
+    async with session.request(method, f"{GEMINI_BASE_URL}/{path}", params=params, timeout=timeout, **kwargs) as r:
+        try:
+            data = await r.json(content_type=None)
+        except ValueError:
+            data = {}
+        return r.status, data if isinstance(data, dict) else {}
+
+
+async def _find_context_cache(route: GeminiRoute, tag: str) -> dict | None:
+    page_token = None
+    for _ in range(10):
+        params = {"pageSize": "100"}
+        if page_token:
+            params["pageToken"] = page_token
+        status, data = await _context_cache_call(route, "GET", "cachedContents", params=params)
+        if status != 200:
+            raise RuntimeError(f"list HTTP {status}: {data}")
+        for obj in data.get("cachedContents") or []:
+            if obj.get("displayName") == tag and obj.get("model") == f"models/{route.model}":
+                return _context_cache_entry(obj)
+        page_token = data.get("nextPageToken")
+        if not page_token:
+            return None
+    return None
+
+
+def _disable_context_cache(route: GeminiRoute, tag: str, reason: str):
+    # постоянный отказ для этого промпта и модели: ретраи не помогут, пока промпт не изменится
+    CONTEXT_CACHE_DISABLED.add(tag)
+    print(f"context cache disabled for {route.model} ({tag}): {reason}", flush=True)
+
+
+async def _context_cache_too_small(route: GeminiRoute, tag: str) -> bool:
+    status, data = await _context_cache_call(
+        route, "POST", f"models/{route.model}:countTokens",
+        json={"contents": [{"role": "user", "parts": [{"text": SYSTEM_PROMPT}]}]},
+    )
+    if status != 200 or "totalTokens" not in data:
+        raise RuntimeError(f"countTokens HTTP {status}: {data}")
+    tokens = int(data["totalTokens"])
+    if tokens < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        _disable_context_cache(route, tag, f"{tokens} tokens < {GEMINI_CONTEXT_CACHE_MIN_TOKENS}")
+        return True
+    return False
+
+
+async def _ensure_context_cache(route: GeminiRoute):
+    """
+    Находит кэш с нашим displayName или создаёт новый;
+    если до истечения меньше GEMINI_CONTEXT_CACHE_REFRESH — продлевает TTL.
+    """
+    k = (route.key_label, route.model)
+    tag = _context_cache_tag(route.model)
+    ttl = {"ttl": f"{GEMINI_CONTEXT_CACHE_TTL}s"}
+    try:
+        if tag in CONTEXT_CACHE_DISABLED:
+            return
+        if k not in CONTEXT_CACHES and await _context_cache_too_small(route, tag):
+            return
+        entry = CONTEXT_CACHES.get(k) or await _find_context_cache(route, tag)
+        if entry is not None and entry["expires_at"] - time.time() <= GEMINI_CONTEXT_CACHE_REFRESH:
+            status, data = await _context_cache_call(
+                route, "PATCH", entry["name"], params={"updateMask": "ttl"}, json=ttl
+            )
+            entry = _context_cache_entry(data) if status == 200 and data.get("name") else None
+        if entry is None:
+            status, data = await _context_cache_call(route, "POST", "cachedContents", json={
+                "model": f"models/{route.model}",
+                "displayName": tag,
+                "systemInstruction": {"parts": [{"text": SYSTEM_PROMPT}]},
+                **ttl,
+            })
+            if status == 400:
+                # INVALID_ARGUMENT (например, контент меньше минимума) — повтор не поможет
+                _disable_context_cache(route, tag, f"create HTTP 400: {data}")
+                return
+            if status != 200 or not data.get("name"):
+                raise RuntimeError(f"create HTTP {status}: {data}")
+            entry = _context_cache_entry(data)
+            print(f"✅ context cache {entry['name']} for {route.key_label}/{route.model}", flush=True)
+        CONTEXT_CACHES[k] = entry
+    except Exception as e:
+        # временно недоступно (квота, сеть, 5xx) — работаем inline, повторим позже
+        CONTEXT_CACHE_RETRY_AT[k] = time.monotonic() + 300
+        print(f"context cache unavailable for {route.key_label}/{route.model}:", e)
+
+
+async def _context_cache_loop():
+    while True:
+        for route in GEMINI_ROUTER.routes:
+            entry = CONTEXT_CACHES.get((route.key_label, route.model))
+            # основная модель — заранее; запасные — когда понадобятся
+            due = entry["expires_at"] - time.time() <= GEMINI_CONTEXT_CACHE_REFRESH if entry else route.model_rank == 0
+            if due and _context_cache_tag(route.model) not in CONTEXT_CACHE_DISABLED:
+                _schedule_context_cache(route)
+        await asyncio.sleep(60)
+
+
+def start_context_cache():
+    global CONTEXT_CACHE_TASK
+    if GEMINI_CONTEXT_CACHE and CONTEXT_CACHE_TASK is None:
+        CONTEXT_CACHE_TASK = asyncio.create_task(_context_cache_loop())
+
+
+async def stop_context_cache():
+    global CONTEXT_CACHE_TASK
+    if CONTEXT_CACHE_TASK is not None:
+        CONTEXT_CACHE_TASK.cancel()
+        await asyncio.gather(CONTEXT_CACHE_TASK, return_exceptions=True)
+        CONTEXT_CACHE_TASK = None
+
+
+# ============================================================
+# ✅ Helpers
+# ============================================================
+def _get_http_session() -> aiohttp.ClientSession:
+    """
+    Общая keep-alive сессия для исходящих HTTP (Gemini).
+    Создаётся лениво внутри работающего event loop.
+    """
+    global HTTP_SESSION, GEMINI_SEM
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=GEMINI_CONCURRENCY, keepalive_timeout=60, ttl_dns_cache=300)
+        HTTP_SESSION = aiohttp.ClientSession(connector=connector)
+    if GEMINI_SEM is None:
+        GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    return HTTP_SESSION
+
+
+async def close_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+
+def _backoff_delay(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    # full jitter: случайная пауза в [0, min(cap, base * 2^attempt)]
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _prepend_context(contents: list[dict], text: str) -> list[dict]:
+    head = [{"text": f"[Контекст для ассистента, не отвечай на него отдельно]\n{text}"}]
+    if contents and contents[0].get("role") == "user":
+        first = {"role": "user", "parts": head + list(contents[0].get("parts") or [])}
+        return [first] + list(contents[1:])
+    return [{"role": "user", "parts": head}] + list(contents)
+
+
+def _gemini_payload(contents: list[dict], system_extra: str | None = None, cached_content: str | None = None) -> dict:
+    generation = {"temperature": 0.75, "maxOutputTokens": 700}
+    if cached_content:
+        GEMINI_PROMPT_MODE.inc("cached")
+        # вместе с cachedContent systemInstruction передавать нельзя —
+        # персональные факты уходят первой частью первой реплики
+        if system_extra:
+            contents = _prepend_context(contents, system_extra)
+        return {"cachedContent": cached_content, "contents": contents, "generationConfig": generation}
+
+    GEMINI_PROMPT_MODE.inc("inline")
+    system_text = SYSTEM_PROMPT if not system_extra else f"{SYSTEM_PROMPT}\n{system_extra}"
+    return {
+        "systemInstruction": {"parts": [{"text": system_text}]},
         "contents": contents,
-        "generationConfig": {"temperature": 0.75, "maxOutputTokens": 700},
+        "generationConfig": generation,
     }
 
-    r = requests.post(endpoint, params={"key": GOOGLE_API_KEY}, json=payload, timeout=20)
-    if r.status_code == 429:
-        raise RuntimeError("429: quota/rate limit")
-    if r.status_code != 200:
-        raise RuntimeError(f"HTTP {r.status_code}: {r.text}")
 
-    data = r.json()
+@instrumented
+async def ask_gemini(contents: list[dict], system_extra: str | None = None) -> str:
+    if not GEMINI_ROUTER.routes:
+        raise RuntimeError("Missing GOOGLE_API_KEY")
+
+    session = _get_http_session()
+    timeout = aiohttp.ClientTimeout(total=GEMINI_TIMEOUT)
+
+    attempt = 0
+    tried: set = set()
+    inline_route = None
+    for _ in range(len(GEMINI_ROUTER.routes) + GEMINI_MAX_RETRIES + 2):
+        if inline_route is not None:
+            # кэш отклонён — тот же ключ/модель, промпт inline
+            route, inline_route = inline_route, None
+            route.begin(count=False)
+        else:
+            route = GEMINI_ROUTER.pick(tried)
+            if route is None:
+                raise GeminiUnavailableError(GEMINI_ROUTER.retry_in())
+        tried.add(route)
+        endpoint = f"{GEMINI_BASE_URL}/models/{route.model}:generateContent"
+        cache_name = context_cache_name(route)
+        payload = _gemini_payload(contents, system_extra, cache_name)
+        try:
+            async with GEMINI_SEM:
+                async with session.post(endpoint, params={"key": route.key}, json=payload, timeout=timeout) as r:
+                    status = r.status
+                    if status == 200:
+                        data = await r.json(content_type=None)
+                    else:
+                        body = await r.text()
+                        retry_after = r.headers.get("Retry-After")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            kind = "timeout" if isinstance(e, asyncio.TimeoutError) else "network"
+            GEMINI_ERRORS.inc(kind)
+            route.failure(kind)
+            if attempt >= GEMINI_MAX_RETRIES:
+                raise RuntimeError(f"Gemini request failed: {e!r}")
+            await asyncio.sleep(_backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        if status == 200:
+            route.success()
+            break
+        if cache_name and _context_cache_rejected(route, status, body):
+            route.cache_rejected()
+            inline_route = route
+            continue
+        verdict = _route_verdict(route, status, body, retry_after)
+        if verdict == "switch":
+            continue
+        if verdict == "retry" and attempt < GEMINI_MAX_RETRIES:
+            await asyncio.sleep(_backoff_delay(attempt))
+            attempt += 1
+            continue
+        raise RuntimeError(f"HTTP {status}: {body}")
+    else:
+        raise GeminiUnavailableError(GEMINI_ROUTER.retry_in())
+
     candidates = data.get("candidates") or []
     if not candidates:
         raise RuntimeError(f"No candidates returned: {data}")
@@ -171,30 +1074,571 @@ def ask_gemini(contents: list[dict]) -> str:
     return parts[0]["text"]
 
 
-def _check_and_update_global_limit() -> tuple[bool, str | None]:
-    today = datetime.now(timezone.utc).date()
-    today_s = str(today)
+class _RetryableGeminiError(Exception):
+    pass
+
+
+class _SwitchGeminiRoute(Exception):
+    pass
+
+
+async def ask_gemini_stream(contents: list[dict], system_extra: str | None = None):
+    """
+    Async-генератор текстовых кусков из streamGenerateContent (SSE).
+    Ретраи и переключение ключа/модели — только до первого полученного куска.
+    """
+    if not GEMINI_ROUTER.routes:
+        raise RuntimeError("Missing GOOGLE_API_KEY")
+
+    session = _get_http_session()
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=GEMINI_TIMEOUT, sock_read=GEMINI_TIMEOUT)
+
+    attempt = 0
+    yielded = False
+    tried: set = set()
+    inline_route = None
+    for _ in range(len(GEMINI_ROUTER.routes) + GEMINI_MAX_RETRIES + 2):
+        if inline_route is not None:
+            # кэш отклонён — тот же ключ/модель, промпт inline
+            route, inline_route = inline_route, None
+            route.begin(count=False)
+        else:
+            route = GEMINI_ROUTER.pick(tried)
+            if route is None:
+                raise GeminiUnavailableError(GEMINI_ROUTER.retry_in())
+        tried.add(route)
+        endpoint = f"{GEMINI_BASE_URL}/models/{route.model}:streamGenerateContent"
+        cache_name = context_cache_name(route)
+        payload = _gemini_payload(contents, system_extra, cache_name)
+        settled = False
+        try:
+            async with GEMINI_SEM:
+                async with session.post(
+                    endpoint,
+                    params={"key": route.key, "alt": "sse"},
+                    json=payload,
+                    timeout=timeout,
+                ) as r:
+                    if r.status != 200:
+                        body = await r.text()
+                        settled = True
+                        if cache_name and _context_cache_rejected(route, r.status, body):
+                            route.cache_rejected()
+                            inline_route = route
+                            raise _SwitchGeminiRoute()
+                        verdict = _route_verdict(route, r.status, body, r.headers.get("Retry-After"))
+                        if verdict == "switch":
+                            raise _SwitchGeminiRoute()
+                        if verdict == "retry" and attempt < GEMINI_MAX_RETRIES:
+                            raise _RetryableGeminiError(f"HTTP {r.status}")
+                        raise RuntimeError(f"HTTP {r.status}: {body}")
+
+                    async for raw in r.content:
+                        line = raw.decode("utf-8", errors="replace").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = json.loads(line[5:].strip() or "{}")
+                        candidates = data.get("candidates") or []
+                        if not candidates:
+                            continue
+                        parts = (candidates[0].get("content") or {}).get("parts") or []
+                        chunk = "".join(p.get("text", "") for p in parts)
+                        if chunk:
+                            yielded = True
+                            yield chunk
+                    settled = True
+                    route.success()
+        except _SwitchGeminiRoute:
+            continue
+        except (_RetryableGeminiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not settled:
+                kind = "timeout" if isinstance(e, asyncio.TimeoutError) else "network"
+                GEMINI_ERRORS.inc(kind)
+                settled = True
+                route.failure(kind)
+            if yielded or attempt >= GEMINI_MAX_RETRIES:
+                raise RuntimeError(f"Gemini stream failed: {e!r}")
+            await asyncio.sleep(_backoff_delay(attempt))
+            attempt += 1
+            continue
+        finally:
+            # генератор закрыли на середине или ответ не разобрался — освобождаем маршрут
+            if not settled:
+                route.release("aborted")
+        return
+    raise GeminiUnavailableError(GEMINI_ROUTER.retry_in())
+
+
+@instrumented
+async def reply_streaming(update: Update, contents: list[dict], system_extra: str | None = None) -> str:
+    """
+    Первый кусок — сразу reply_text, дальше куски склеиваются и
+    применяются через edit_message_text не чаще STREAM_EDIT_INTERVAL.
+    Возвращает полный текст ответа.
+    """
+    msg = None
+    text = ""
+    shown = ""
+    last_edit = 0.0
+
+    async for chunk in ask_gemini_stream(contents, system_extra):
+        text += chunk
+        if msg is None:
+            shown = text[:TG_MAX_MESSAGE_LEN]
+            msg = await update.message.reply_text(shown)
+            last_edit = time.monotonic()
+            continue
+        if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            new_shown = text[:TG_MAX_MESSAGE_LEN]
+            if new_shown != shown:
+                try:
+                    await msg.edit_text(new_shown)
+                    shown = new_shown
+                except Exception as e:
+                    print("stream edit failed:", e)
+            last_edit = time.monotonic()
+
+    if msg is None:
+        raise RuntimeError("Empty stream from Gemini")
+
+    final = text[:TG_MAX_MESSAGE_LEN]
+    if final != shown:
+        try:
+            await msg.edit_text(final)
+        except Exception as e:
+            print("stream final edit failed:", e)
+
+    return text
+
+
+# ============================================================
+# ✅ Context builder (facts -> systemInstruction, token budget)
+# ============================================================
+def estimate_tokens(text: str) -> int:
+    # грубо: ~3 символа на токен для смеси кириллицы и латиницы
+    return len(text) // 3 + 1
+
+
+def _turn_text(turn: dict) -> str:
+    return "".join(p.get("text", "") for p in turn.get("parts") or [])
+
+
+def build_user_facts(name_form: str | None, niche_form: str | None, niche_db: str | None) -> str:
+    """
+    Факты о пользователе — один раз в systemInstruction, а не в каждой реплике.
+    Формулировка «Mini App уже заполнен: ДА» совпадает с КЛЮЧЕВЫМ ПРАВИЛОМ промпта.
+    """
+    lines = ["Контекст пользователя:"]
+    if niche_form:
+        lines.append(f"Mini App уже заполнен: ДА. Имя из формы: {name_form or '-'}, Ниша из формы: {niche_form}")
+    else:
+        lines.append("Mini App уже заполнен: НЕТ")
+    if niche_db:
+        lines.append(f"Ниша/род деятельности пользователя: {niche_db}")
+    return "\n".join(lines) + "\n"
+
+
+def compact_history(history: list[dict], summary: str, budget: int | None = None) -> tuple[list[dict], str]:
+    """
+    Держит историю в пределах MAX_TURNS и бюджета токенов: самые старые
+    реплики сворачиваются в короткое локальное резюме (без вызова модели).
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    history = list(history)
+    folded: list[str] = []
+
+    def over() -> bool:
+        if len(history) > MAX_TURNS * 2:
+            return True
+        return sum(estimate_tokens(_turn_text(t)) for t in history) > budget
+
+    # последнюю реплику пользователя не трогаем никогда
+    while len(history) > 1 and over():
+        turn = history.pop(0)
+        who = "Пользователь" if turn.get("role") == "user" else "Soffi"
+        text = " ".join(_turn_text(turn).split())
+        folded.append(f"{who}: {text[:200]}")
+    while len(history) > 1 and history[0].get("role") != "user":
+        turn = history.pop(0)
+        folded.append(f"Soffi: {' '.join(_turn_text(turn).split())[:200]}")
+
+    if folded:
+        summary = (summary + "\n" if summary else "") + "\n".join(folded)
+        if len(summary) > SUMMARY_MAX_CHARS:
+            summary = "…" + summary[-SUMMARY_MAX_CHARS:]
+    return history, summary
+
+
+def build_system_extra(facts: str, summary: str) -> str:
+    if not summary:
+        return facts
+    return f"{facts}\nКратко о более ранней части диалога:\n{summary}\n"
+
+
+# ============================================================
+# ✅ Response cache (Gemini)
+# ============================================================
+def _normalize_for_cache(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = "".join(ch if ch.isalnum() or ch.isspace() else " " for ch in text)
+    return " ".join(text.split())
+
+
+def response_cache_key(text: str, miniapp_filled: bool, turn: int) -> str | None:
+    """
+    Ключ = нормализованный текст + грубый отпечаток воронки.
+    Длинные реплики и поздние ходы диалога не кэшируем — там важен контекст.
+    """
+    norm = _normalize_for_cache(text)
+    if not norm or len(norm) > RESPONSE_CACHE_MAX_TEXT or turn > RESPONSE_CACHE_MAX_TURN:
+        return None
+    raw = f"{MODEL}|{int(miniapp_filled)}|{turn}|{norm}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def response_cache_get(key: str) -> str | None:
+    hit = RESPONSE_CACHE.get(key)
+    if hit is not None and hit[0] > time.monotonic():
+        RESPONSE_CACHE.move_to_end(key)
+        return hit[1]
+    RESPONSE_CACHE.pop(key, None)
+
+    if RESPONSE_CACHE_PG and DB_POOL:
+        try:
+            async with db_acquire() as conn:
+                answer = await conn.fetchval(
+                    """
+                    SELECT answer FROM gemini_cache
+                    WHERE key=$1 AND created_at > now() - make_interval(secs => $2)
+                    """,
+                    key, float(RESPONSE_CACHE_TTL),
+                )
+        except Exception as e:
+            print("gemini_cache read failed:", e)
+            answer = None
+        if answer:
+            _response_cache_put_local(key, answer)
+            return answer
+    return None
+
+
+def _response_cache_put_local(key: str, answer: str):
+    RESPONSE_CACHE[key] = (time.monotonic() + RESPONSE_CACHE_TTL, answer)
+    RESPONSE_CACHE.move_to_end(key)
+    while len(RESPONSE_CACHE) > RESPONSE_CACHE_MAX:
+        RESPONSE_CACHE.popitem(last=False)
+
+
+async def response_cache_put(key: str, answer: str, personal: tuple[str | None, ...] = ()):
+    # ответ с именем/нишей конкретного пользователя другим не отдаём
+    low = answer.lower()
+    if any(p and p.strip() and p.strip().lower() in low for p in personal):
+        return
+    _response_cache_put_local(key, answer)
+    RESPONSE_CACHE_STATS["stores"] += 1
+
+    if RESPONSE_CACHE_PG and DB_POOL:
+        try:
+            async with db_acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO gemini_cache (key, answer, created_at) VALUES ($1, $2, now())
+                    ON CONFLICT (key) DO UPDATE SET answer = EXCLUDED.answer, created_at = now()
+                    """,
+                    key, answer,
+                )
+        except Exception as e:
+            print("gemini_cache write failed:", e)
+
+
+def response_cache_record(hit: bool, gemini_seconds: float | None = None):
+    st = RESPONSE_CACHE_STATS
+    if gemini_seconds is not None:
+        st["gemini_latency_avg"] = gemini_seconds if not st["gemini_latency_avg"] else (
+            0.9 * st["gemini_latency_avg"] + 0.1 * gemini_seconds
+        )
+    if hit:
+        st["hits"] += 1
+        st["saved_seconds"] += st["gemini_latency_avg"]
+    else:
+        st["misses"] += 1
+
+
+# ============================================================
+# ✅ Rate limiting (token buckets: global + per tg_id)
+# ============================================================
+class MemoryBucketStore:
+    """
+    Локальное хранилище бакетов (один процесс / тесты).
+    """
+
+    def __init__(self):
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    async def take(self, key: str, capacity: float, refill_per_sec: float, n: int) -> int:
+        now = time.time()
+        tokens, ts = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - ts) * refill_per_sec)
+        granted = int(min(n, tokens))
+        self._buckets[key] = (tokens - granted, now)
+        return granted
+
+    async def peek(self, key: str, capacity: float, refill_per_sec: float) -> float:
+        now = time.time()
+        tokens, ts = self._buckets.get(key, (capacity, now))
+        return min(capacity, tokens + (now - ts) * refill_per_sec)
+
+    async def give(self, key: str, capacity: float, refill_per_sec: float, n: int):
+        now = time.time()
+        tokens, ts = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - ts) * refill_per_sec + n)
+        self._buckets[key] = (tokens, now)
+
+    async def give_many(self, items: list[tuple[str, float, float, int]]):
+        for key, capacity, refill_per_sec, n in items:
+            await self.give(key, capacity, refill_per_sec, n)
+
+
+class PgBucketStore:
+    """
+    Бакеты в таблице rate_buckets: списание атомарно (SELECT ... FOR UPDATE в CTE),
+    поэтому лимит общий для всех процессов и переживает рестарт.
+    """
+
+    async def take(self, key: str, capacity: float, refill_per_sec: float, n: int) -> int:
+        async with db_acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO rate_buckets (key, tokens, updated_at)
+                VALUES ($1, $2, now())
+                ON CONFLICT (key) DO NOTHING
+                """,
+                key, float(capacity),
+            )
+            granted = await conn.fetchval(
+                """
+                WITH cur AS (
+                  SELECT LEAST($2::float8, tokens + EXTRACT(EPOCH FROM (now() - updated_at)) * $3::float8) AS t
+                  FROM rate_buckets
+                  WHERE key=$1
+                  FOR UPDATE
+                )
+                UPDATE rate_buckets AS rb
+                SET tokens = cur.t - LEAST($4::float8, floor(cur.t)),
+                    updated_at = now()
+                FROM cur
+                WHERE rb.key=$1
+                RETURNING LEAST($4::float8, floor(cur.t))::int
+                """,
+                key, float(capacity), float(refill_per_sec), int(n),
+            )
+        return int(granted or 0)
+
+    async def peek(self, key: str, capacity: float, refill_per_sec: float) -> float:
+        async with db_acquire() as conn:
+            tokens = await conn.fetchval(
+                """
+                SELECT LEAST($2::float8, tokens + EXTRACT(EPOCH FROM (now() - updated_at)) * $3::float8)
+                FROM rate_buckets
+                WHERE key=$1
+                """,
+                key, float(capacity), float(refill_per_sec),
+            )
+        return float(capacity if tokens is None else tokens)
+
+    async def give(self, key: str, capacity: float, refill_per_sec: float, n: int):
+        async with db_acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE rate_buckets
+                SET tokens = LEAST($2::float8, tokens + EXTRACT(EPOCH FROM (now() - updated_at)) * $3::float8 + $4::float8),
+                    updated_at = now()
+                WHERE key=$1
+                """,
+                key, float(capacity), float(refill_per_sec), int(n),
+            )
+
+    async def give_many(self, items: list[tuple[str, float, float, int]]):
+        # все возвраты одним UPDATE, а не по запросу на ключ
+        if not items:
+            return
+        async with db_acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE rate_buckets AS rb
+                SET tokens = LEAST(g.capacity, rb.tokens + EXTRACT(EPOCH FROM (now() - rb.updated_at)) * g.refill + g.n),
+                    updated_at = now()
+                FROM unnest($1::text[], $2::float8[], $3::float8[], $4::float8[]) AS g(key, capacity, refill, n)
+                WHERE rb.key = g.key
+                """,
+                [k for k, _, _, _ in items], [float(c) for _, c, _, _ in items],
+                [float(r) for _, _, r, _ in items], [float(n) for _, _, _, n in items],
+            )
+
 
-    if GLOBAL_LIMIT.get("blocked_date") == today_s:
-        return False, "⚠️ Лимит на сегодня исчерпан. Попробуйте завтра."
+class RateLimiter:
+    """
+    Глобальный бакет (MAX_REQUESTS_PER_DAY в сутки) + бакет на каждого tg_id.
+    Токены берутся из store «арендой» и тратятся локально, так что горячий
+    путь обычно не ходит в БД. Аренда начинается с одного токена и растёт
+    (до lease_size) только если прошлую израсходовали раньше RATE_LEASE_TTL;
+    неистраченный остаток по истечении возвращается в store — фоновым sweep()
+    одним запросом, вне пути обработки сообщения.
+    """
 
-    if GLOBAL_LIMIT.get("date") != today_s:
-        GLOBAL_LIMIT["date"] = today_s
-        GLOBAL_LIMIT["count"] = 0
-        GLOBAL_LIMIT["blocked_date"] = None
+    def __init__(self, store):
+        self.store = store
+        self._leases: dict[str, list[float]] = {}  # key -> [tokens, expires_at]
+        self._lease_size: dict[str, int] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    @staticmethod
+    def _spec(key: str) -> tuple[float, float]:
+        per_day = MAX_REQUESTS_PER_DAY if key == "global" else USER_MAX_REQUESTS_PER_DAY
+        return float(per_day), per_day / 86400.0
+
+    def _local_take(self, key: str) -> bool:
+        lease = self._leases.get(key)
+        if lease and lease[0] >= 1 and lease[1] > time.monotonic():
+            lease[0] -= 1
+            return True
+        return False
+
+    async def _take(self, key: str, lease_size: int) -> bool:
+        if self._local_take(key):
+            return True
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if self._local_take(key):
+                return True
+            capacity, refill = self._spec(key)
+            now = time.monotonic()
+            size = self._lease_size.get(key, 1)
+            lease = self._leases.pop(key, None)
+            if lease is not None and lease[0] >= 1:
+                # истекла с остатком — трафик редкий: возвращаем и берём по одному
+                await self.store.give(key, capacity, refill, int(lease[0]))
+                size = 1
+            elif lease is not None and lease[1] > now:
+                size = min(lease_size, size * 2)
+            granted = await self.store.take(key, capacity, refill, size)
+            if granted <= 0:
+                self._lease_size.pop(key, None)
+                self._locks.pop(key, None)
+                return False
+            self._lease_size[key] = size
+            self._leases[key] = [granted - 1, now + RATE_LEASE_TTL]
+            return True
+
+    async def _return_leases(self, keys: list[str]):
+        # снимаем аренды синхронно (до await), возвращаем остатки одним вызовом store
+        items = []
+        for key in keys:
+            lease = self._leases.pop(key, None)
+            self._lease_size.pop(key, None)
+            self._locks.pop(key, None)
+            if lease is not None and lease[0] >= 1:
+                capacity, refill = self._spec(key)
+                items.append((key, capacity, refill, int(lease[0])))
+        if items:
+            try:
+                await self.store.give_many(items)
+            except Exception as e:
+                print(f"rate lease return failed ({len(items)} keys):", e)
+
+    async def sweep(self):
+        """Возвращает в store остатки всех истёкших аренд."""
+        now = time.monotonic()
+        expired = [
+            k for k, v in self._leases.items()
+            if v[1] <= now and not (k in self._locks and self._locks[k].locked())
+        ]
+        await self._return_leases(expired)
+
+    async def release_all(self):
+        # при остановке процесса аренда не должна пропасть
+        await self._return_leases(list(self._leases))
+
+    def _refund(self, key: str):
+        lease = self._leases.get(key)
+        if lease:
+            lease[0] += 1
+
+    async def acquire(self, tg_id: int) -> tuple[bool, str | None]:
+        user_key = f"user:{int(tg_id)}"
+        if not await self._take(user_key, RATE_LEASE_USER):
+            return False, USER_LIMIT_REACHED_TEXT
+        if not await self._take("global", RATE_LEASE_GLOBAL):
+            self._refund(user_key)
+            return False, LIMIT_REACHED_TEXT
+        return True, None
+
+    async def remaining(self, tg_id: int | None = None) -> int:
+        key = "global" if tg_id is None else f"user:{int(tg_id)}"
+        capacity, refill = self._spec(key)
+        tokens = await self.store.peek(key, capacity, refill)
+        lease = self._leases.get(key)
+        if lease and lease[1] > time.monotonic():
+            tokens += lease[0]
+        return int(tokens)
+
+
+RATE_LIMITER = RateLimiter(MemoryBucketStore())
+RATE_SWEEP_TASK: asyncio.Task | None = None
+
+
+async def _rate_sweep_loop():
+    while True:
+        await asyncio.sleep(RATE_LEASE_TTL)
+        try:
+            await RATE_LIMITER.sweep()
+        except Exception as e:
+            print("rate lease sweep failed:", e)
+
+
+def start_rate_sweeper():
+    global RATE_SWEEP_TASK
+    if RATE_SWEEP_TASK is None:
+        RATE_SWEEP_TASK = asyncio.create_task(_rate_sweep_loop())
+
+
+async def stop_rate_sweeper():
+    global RATE_SWEEP_TASK
+    if RATE_SWEEP_TASK is not None:
+        RATE_SWEEP_TASK.cancel()
+        await asyncio.gather(RATE_SWEEP_TASK, return_exceptions=True)
+        RATE_SWEEP_TASK = None
+
+
+@functools.lru_cache(maxsize=4)
+def _webapp_secret_key(bot_token: str) -> bytes:
+    return hmac.new(
+        key=b"WebAppData",
+        msg=bot_token.encode("utf-8"),
+        digestmod=hashlib.sha256
+    ).digest()
 
-    if GLOBAL_LIMIT["count"] >= MAX_REQUESTS_PER_DAY:
-        GLOBAL_LIMIT["blocked_date"] = today_s
-        return False, "⚠️ Лимит на сегодня исчерпан. Попробуйте завтра."
 
-    GLOBAL_LIMIT["count"] += 1
-    return True, None
+@functools.lru_cache(maxsize=4)
+def _session_key(bot_token: str) -> bytes:
+    seed = SESSION_SECRET or bot_token
+    return hmac.new(key=b"AWMSession", msg=seed.encode("utf-8"), digestmod=hashlib.sha256).digest()
 
 
-def verify_telegram_webapp_init_data(init_data: str, bot_token: str) -> dict:
+def verify_telegram_webapp_init_data(init_data: str, bot_token: str, max_age: int | None = None) -> dict:
     if not init_data:
         raise ValueError("Missing initData")
 
+    max_age = WEBAPP_AUTH_MAX_AGE if max_age is None else max_age
+    now = time.time()
+    cache_key = hashlib.sha256(init_data.encode("utf-8")).hexdigest()
+    hit = WEBAPP_AUTH_CACHE.get(cache_key)
+    if hit is not None:
+        if hit[0] > now:
+            WEBAPP_AUTH_CACHE.move_to_end(cache_key)
+            return dict(hit[1])
+        WEBAPP_AUTH_CACHE.pop(cache_key, None)
+
     data = dict(parse_qsl(init_data, keep_blank_values=True))
     received_hash = data.pop("hash", None)
     if not received_hash:
@@ -202,14 +1646,8 @@ def verify_telegram_webapp_init_data(init_data: str, bot_token: str) -> dict:
 
     check_string = "\n".join([f"{k}={data[k]}" for k in sorted(data.keys())])
 
-    secret_key = hmac.new(
-        key=b"WebAppData",
-        msg=bot_token.encode("utf-8"),
-        digestmod=hashlib.sha256
-    ).digest()
-
     calculated_hash = hmac.new(
-        key=secret_key,
+        key=_webapp_secret_key(bot_token),
         msg=check_string.encode("utf-8"),
         digestmod=hashlib.sha256
     ).hexdigest()
@@ -217,150 +1655,1767 @@ def verify_telegram_webapp_init_data(init_data: str, bot_token: str) -> dict:
     if not hmac.compare_digest(calculated_hash, received_hash):
         raise ValueError("Invalid initData hash")
 
+    try:
+        auth_date = int(data.get("auth_date") or 0)
+    except ValueError:
+        raise ValueError("Bad auth_date")
+    if max_age and (auth_date <= 0 or now - auth_date > max_age):
+        raise ValueError("initData expired")
+    if auth_date - now > 60:
+        raise ValueError("auth_date in the future")
+
     if "user" in data:
         data["user"] = json.loads(data["user"])
 
-    return data
+    valid_until = auth_date + max_age if max_age else now + 3600
+    WEBAPP_AUTH_CACHE[cache_key] = (valid_until, data)
+    while len(WEBAPP_AUTH_CACHE) > WEBAPP_AUTH_CACHE_MAX:
+        WEBAPP_AUTH_CACHE.popitem(last=False)
+
+    return dict(data)
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def issue_session_token(user: dict, bot_token: str, ttl: int | None = None) -> str:
+    """
+    Компактный токен «payload.sig»: id/имя/username + срок, HMAC-SHA256 (16 байт).
+    """
+    payload = {
+        "u": int(user["id"]),
+        "f": user.get("first_name") or "",
+        "n": user.get("username") or "",
+        "e": int(time.time()) + (WEBAPP_SESSION_TTL if ttl is None else ttl),
+    }
+    body = _b64(json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+    sig = hmac.new(_session_key(bot_token), body.encode("ascii"), hashlib.sha256).digest()[:16]
+    return f"{body}.{_b64(sig)}"
+
+
+def verify_session_token(token: str, bot_token: str) -> dict:
+    """
+    Одна HMAC-проверка вместо полной верификации initData.
+    Возвращает user-словарь в формате initData ({"id", "first_name", "username"}).
+    """
+    try:
+        body, sig = token.split(".", 1)
+        expected = hmac.new(_session_key(bot_token), body.encode("ascii"), hashlib.sha256).digest()[:16]
+        valid = hmac.compare_digest(expected, _unb64(sig))
+        payload = json.loads(_unb64(body)) if valid else None
+    except (ValueError, UnicodeError):
+        raise ValueError("Malformed session token")
+    if not valid:
+        raise ValueError("Invalid session token")
+    if int(payload.get("e") or 0) < time.time():
+        raise ValueError("Session token expired")
+    return {"id": int(payload["u"]), "first_name": payload.get("f") or "", "username": payload.get("n") or ""}
+
+
+def miniapp_auth(request: web.Request, body: dict) -> tuple[dict, str]:
+    """
+    Общая авторизация для /api/...: Bearer-токен сессии или initData.
+    Возвращает (user, credential) — credential годится как основа ключа идемпотентности.
+    """
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        token = auth[7:].strip()
+        return verify_session_token(token, TOKEN), token
+
+    init_data = body.get("initData") or ""
+    parsed = verify_telegram_webapp_init_data(init_data, TOKEN)
+    return parsed.get("user") or {}, init_data
 
 
 # ============================================================
 # ✅ DB helpers
 # ============================================================
-async def db_get_user_niche(tg_id: int) -> str | None:
-    if not DB_POOL:
-        return None
-    async with DB_POOL.acquire() as conn:
-        return await conn.fetchval("SELECT business_niche FROM users WHERE tg_id=$1", int(tg_id))
-
-
-async def db_get_latest_miniapp_profile(tg_id: int) -> tuple[str | None, str | None]:
+@instrumented
+async def db_get_user_profile(tg_id: int) -> tuple[str | None, str | None, str | None]:
     """
-    Надёжно: последняя miniapp-заявка по id (не зависит от created_at).
+    Один запрос вместо двух: (name_from_form, niche_from_form) последней
+    miniapp-заявки по id + business_niche из users.
     """
     if not DB_POOL:
-        return None, None
-    async with DB_POOL.acquire() as conn:
+        return None, None, None
+    async with db_acquire() as conn:
         row = await conn.fetchrow(
             """
-            SELECT name_from_form, niche_from_form
-            FROM leads
-            WHERE tg_id=$1 AND source='miniapp'
-            ORDER BY id DESC
-            LIMIT 1
+            SELECT l.name_from_form, l.niche_from_form,
+                   (SELECT business_niche FROM users WHERE tg_id=$1) AS business_niche
+            FROM (SELECT 1) AS one
+            LEFT JOIN LATERAL (
+              SELECT name_from_form, niche_from_form
+              FROM leads
+              WHERE tg_id=$1 AND source='miniapp'
+              ORDER BY id DESC
+              LIMIT 1
+            ) AS l ON true
             """,
             int(tg_id),
         )
     if not row:
-        return None, None
-    return (row["name_from_form"], row["niche_from_form"])
+        return None, None, None
+    return (row["name_from_form"], row["niche_from_form"], row["business_niche"])
 
 
-async def db_log_message(tg_id: int, direction: str, text: str):
-    if not DB_POOL:
-        return
-    text = (text or "").strip()
-    if not text:
-        return
-    async with DB_POOL.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO messages (tg_id, direction, text) VALUES ($1, $2, $3)",
-            int(tg_id), direction, text
-        )
+async def get_user_profile(tg_id: int) -> tuple[str | None, str | None, str | None]:
+    """
+    (name_form, niche_form, niche_db) через PROFILE_CACHE.
+    """
+    tg_id = int(tg_id)
+    hit = PROFILE_CACHE.get(tg_id)
+    if hit is not None and hit[0] > time.monotonic():
+        PROFILE_CACHE.move_to_end(tg_id)
+        return hit[1]
 
+    profile = await db_get_user_profile(tg_id)
+    if DB_POOL:
+        PROFILE_CACHE[tg_id] = (time.monotonic() + PROFILE_CACHE_TTL, profile)
+        PROFILE_CACHE.move_to_end(tg_id)
+        while len(PROFILE_CACHE) > PROFILE_CACHE_MAX:
+            PROFILE_CACHE.popitem(last=False)
+    return profile
 
-async def db_log_event(event: str, source: str, tg_id: int | None = None, lead_id: int | None = None, meta: dict | None = None):
-    if not DB_POOL:
-        return
-    async with DB_POOL.acquire() as conn:
+
+def invalidate_user_profile(tg_id: int):
+    PROFILE_CACHE.pop(int(tg_id), None)
+
+
+async def _rollup_events(conn, events: list[tuple]):
+    """
+    Инкрементально обновляет funnel_daily (день × source × event) и
+    funnel_stages (первое достижение этапа воронки пользователем)
+    в той же транзакции, что и вставка lead_events.
+    """
+    counts: dict[tuple[date, str, str], int] = {}
+    stages: dict[tuple[int, str], datetime] = {}
+    for tg_id, _lead_id, event, source, _meta, created_at in events:
+        day = created_at.astimezone(timezone.utc).date()
+        key = (day, source or "-", event)
+        counts[key] = counts.get(key, 0) + 1
+        if tg_id is not None and event in FUNNEL_STAGES:
+            stages.setdefault((tg_id, event), created_at)
+
+    await conn.execute(
+        """
+        INSERT INTO funnel_daily (day, source, event, n)
+        SELECT * FROM unnest($1::date[], $2::text[], $3::text[], $4::bigint[])
+        ON CONFLICT (day, source, event) DO UPDATE SET n = funnel_daily.n + EXCLUDED.n
+        """,
+        [k[0] for k in counts], [k[1] for k in counts], [k[2] for k in counts], list(counts.values()),
+    )
+    if stages:
         await conn.execute(
             """
-            INSERT INTO lead_events (tg_id, lead_id, event, source, meta)
-            VALUES ($1, $2, $3, $4, $5)
+            WITH ins AS (
+              INSERT INTO funnel_stages (tg_id, stage, reached_at)
+              SELECT * FROM unnest($1::bigint[], $2::text[], $3::timestamptz[])
+              ON CONFLICT (tg_id, stage) DO NOTHING
+              RETURNING stage, reached_at
+            )
+            INSERT INTO funnel_daily (day, source, event, n)
+            SELECT (reached_at AT TIME ZONE 'UTC')::date, '*', 'stage:' || stage, count(*)
+            FROM ins
+            GROUP BY 1, 3
+            ON CONFLICT (day, source, event) DO UPDATE SET n = funnel_daily.n + EXCLUDED.n
             """,
-            int(tg_id) if tg_id is not None else None,
-            int(lead_id) if lead_id is not None else None,
-            event,
-            source,
-            json.dumps(meta or {}),
+            [k[0] for k in stages], [k[1] for k in stages], list(stages.values()),
         )
 
 
-async def send_owner_report(period: str = "day"):
-    if not OWNER_ID or not DB_POOL or tg_app is None:
-        return
+# сбои, после которых та же пачка может записаться: сеть, рестарт/перегрузка БД, конфликт транзакций
+LOG_TRANSIENT_ERRORS = (
+    OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError,
+    asyncpg.OperatorInterventionError, asyncpg.TooManyConnectionsError,
+    asyncpg.SerializationError, asyncpg.DeadlockDetectedError,
+)
 
-    interval = "1 day" if period == "day" else "7 days"
-    async with DB_POOL.acquire() as conn:
-        ev_rows = await conn.fetch(
-            f"""
-            SELECT tg_id, source, created_at
-            FROM lead_events
-            WHERE created_at >= now() - interval '{interval}'
-            ORDER BY created_at ASC
+
+async def _write_log_rows(batch: list[tuple[str, tuple]]):
+    messages = [rec for table, rec in batch if table == "messages"]
+    events = [rec for table, rec in batch if table == "lead_events"]
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            if messages:
+                await conn.copy_records_to_table("messages", records=messages, columns=MESSAGES_COLUMNS)
+            if events:
+                await conn.copy_records_to_table("lead_events", records=events, columns=LEAD_EVENTS_COLUMNS)
+                # savepoint: сломанная агрегация не должна откатывать сами строки
+                try:
+                    async with conn.transaction():
+                        await _rollup_events(conn, events)
+                except asyncpg.PostgresError as e:
+                    print(f"funnel rollup failed ({len(events)} events), raw rows kept:", e)
+
+
+@instrumented
+async def _flush_log_batch(batch: list[tuple[str, tuple]]) -> list[tuple[str, tuple]]:
+    """
+    Пишет пачку строк одной транзакцией через COPY.
+    Порядок внутри каждой таблицы сохраняется (а значит и по tg_id).
+    Возвращает хвост пачки, который не записан из-за временного сбоя БД и
+    должен быть повторён. Если пачку отверг сам Postgres (например, \\x00 в тексте),
+    она пишется по одной строке, а отвергнутые строки выводятся в лог и отбрасываются —
+    иначе одна «ядовитая» строка навсегда блокировала бы очередь.
+    """
+    if not DB_POOL or not batch:
+        return []
+    try:
+        await _write_log_rows(batch)
+        return []
+    except LOG_TRANSIENT_ERRORS as e:
+        print(f"log flush failed ({len(batch)} rows), will retry:", e)
+        return batch
+    except Exception as e:
+        if len(batch) > 1:
+            print(f"log flush rejected ({len(batch)} rows), writing one by one:", e)
+
+    for i, item in enumerate(batch):
+        try:
+            await _write_log_rows([item])
+        except LOG_TRANSIENT_ERRORS as e:
+            print(f"log flush failed ({len(batch) - i} rows), will retry:", e)
+            return batch[i:]
+        except Exception as e:
+            print(f"log row dropped ({item[0]}): {e}; {item[1]!r:.300}", flush=True)
+    return []
+
+
+async def _log_writer_loop():
+    """
+    Единственный потребитель LOG_QUEUE: копит пачку до LOG_BATCH_SIZE
+    или LOG_FLUSH_INTERVAL секунд, затем сбрасывает. None — сигнал остановки.
+    Не записанный из-за сбоя БД хвост остаётся первым и повторяется с экспоненциальной
+    паузой; task_done — только после записи, поэтому log_flush_pending честно ждёт БД.
+    """
+    stop = False
+    batch: list = []
+    failures = 0
+    while True:
+        if not batch:
+            if stop:
+                break
+            item = await LOG_QUEUE.get()
+            if item is None:
+                LOG_QUEUE.task_done()
+                break
+            batch = [item]
+
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while not stop and len(batch) < LOG_BATCH_SIZE:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(LOG_QUEUE.get(), left)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stop = True
+                LOG_QUEUE.task_done()
+                break
+            batch.append(item)
+
+        left = await _flush_log_batch(batch)
+        for _ in range(len(batch) - len(left)):
+            LOG_QUEUE.task_done()
+        batch = left
+        if not batch:
+            failures = 0
+            continue
+        failures += 1
+        if not (stop and failures > LOG_STOP_RETRIES):
+            await asyncio.sleep(min(LOG_RETRY_MAX_DELAY, 0.5 * 2 ** failures))
+            continue
+        print(f"log flush: giving up on {len(batch)} rows at shutdown", flush=True)
+        for _ in batch:
+            LOG_QUEUE.task_done()
+        batch = []
+        failures = 0
+
+
+def start_log_writer():
+    global LOG_QUEUE, LOG_WRITER_TASK
+    LOG_QUEUE = asyncio.Queue(maxsize=LOG_QUEUE_MAX)
+    LOG_WRITER_TASK = asyncio.create_task(_log_writer_loop())
+
+
+async def stop_log_writer():
+    """
+    Останавливает writer, предварительно дописав всё, что в очереди.
+    """
+    global LOG_WRITER_TASK
+    if LOG_QUEUE is None or LOG_WRITER_TASK is None:
+        return
+    if not LOG_WRITER_TASK.done():
+        await LOG_QUEUE.put(None)
+        await LOG_WRITER_TASK
+    LOG_WRITER_TASK = None
+
+
+async def log_flush_pending():
+    """
+    Дождаться, пока всё уже поставленное в очередь попадёт в БД
+    (нужно перед DELETE в /forget, чтобы строки не «воскресли»).
+    """
+    if LOG_QUEUE is not None and LOG_WRITER_TASK is not None and not LOG_WRITER_TASK.done():
+        await LOG_QUEUE.join()
+
+
+async def _log_enqueue(table: str, record: tuple):
+    # put() ждёт при переполненной очереди — это и есть backpressure
+    if LOG_QUEUE is None or LOG_WRITER_TASK is None or LOG_WRITER_TASK.done():
+        await _flush_log_batch([(table, record)])
+        return
+    await LOG_QUEUE.put((table, record))
+
+
+@instrumented
+async def db_log_message(tg_id: int, direction: str, text: str):
+    if not DB_POOL:
+        return
+    text = (text or "").strip()
+    if not text:
+        return
+    await _log_enqueue("messages", (int(tg_id), direction, text, datetime.now(timezone.utc)))
+
+
+@instrumented
+async def db_log_event(event: str, source: str, tg_id: int | None = None, lead_id: int | None = None, meta: dict | None = None):
+    if not DB_POOL:
+        return
+    await _log_enqueue("lead_events", (
+        int(tg_id) if tg_id is not None else None,
+        int(lead_id) if lead_id is not None else None,
+        event,
+        source,
+        json.dumps(meta or {}),
+        datetime.now(timezone.utc),
+    ))
+
+
+def _report_range(period: str) -> tuple[date, date]:
+    """
+    day | yesterday | week | <N>d | YYYY-MM-DD [YYYY-MM-DD] -> (date_from, date_to)
+    включительно, календарные дни UTC ("day" — сегодня с 00:00 UTC, а не последние 24 часа).
+    Любой неразборчивый или слишком длинный период — ValueError.
+    """
+    today = datetime.now(timezone.utc).date()
+    period = (period or "day").strip().lower()
+    if period == "day":
+        return today, today
+    if period == "yesterday":
+        return today - timedelta(days=1), today - timedelta(days=1)
+    if period == "week":
+        return today - timedelta(days=6), today
+    if period.endswith("d") and period[:-1].isdigit():
+        days = int(period[:-1])
+        if days > REPORT_MAX_DAYS:
+            # иначе timedelta/date падают с OverflowError мимо обработчиков ValueError
+            raise ValueError(f"period out of range (max {REPORT_MAX_DAYS} days)")
+        return today - timedelta(days=max(1, days) - 1), today
+    parts = period.split()
+    d_from = date.fromisoformat(parts[0])
+    d_to = date.fromisoformat(parts[1]) if len(parts) > 1 else d_from
+    if d_to < d_from:
+        d_from, d_to = d_to, d_from
+    if (d_to - d_from).days >= REPORT_MAX_DAYS or d_to >= date.max:
+        # d_to + 1 день считается при выгрузке — на date.max это OverflowError
+        raise ValueError(f"period out of range (max {REPORT_MAX_DAYS} days)")
+    return d_from, d_to
+
+
+async def send_owner_report(period: str = "day"):
+    if not OWNER_ID or not DB_POOL or tg_app is None:
+        return
+
+    try:
+        d_from, d_to = _report_range(period)
+    except ValueError:
+        period = "day"
+        d_from, d_to = _report_range(period)
+
+    async with db_acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT source, event, sum(n)::bigint AS n
+            FROM funnel_daily
+            WHERE day BETWEEN $1 AND $2
+            GROUP BY source, event
+            ORDER BY event, source
+            """,
+            d_from, d_to,
+        )
+
+    stage_n = {st: 0 for st in FUNNEL_STAGES}
+    by_event: dict[str, list[str]] = {}
+    for r in rows:
+        if r["event"].startswith("stage:"):
+            stage_n[r["event"][6:]] = int(r["n"])
+        else:
+            by_event.setdefault(r["event"], []).append(f"{r['source']}: {r['n']}")
+
+    span = str(d_from) if d_from == d_to else f"{d_from} — {d_to}"
+    lines = [f"📊 Отчёт за {period} ({span}, UTC)", ""]
+
+    lines.append("🧭 Воронка (новые пользователи на этапе):")
+    prev = None
+    first = stage_n[FUNNEL_STAGES[0]]
+    for st in FUNNEL_STAGES:
+        n = stage_n[st]
+        line = f"• {st}: {n}"
+        if prev is not None:
+            step = f"{n / stage_n[prev] * 100:.0f}%" if stage_n[prev] else "—"
+            total = f"{n / first * 100:.0f}%" if first else "—"
+            line += f" (шаг {step}, от start {total})"
+        lines.append(line)
+        prev = st
+    lines.append("")
+
+    if by_event:
+        lines.append("📌 События:")
+        for event, per_source in by_event.items():
+            lines.append(f"• {event} — {', '.join(per_source)}")
+        lines.append("")
+
+    try:
+        remaining = await RATE_LIMITER.remaining()
+        lines.append(f"🔋 Лимит Gemini: осталось ~{remaining} из {MAX_REQUESTS_PER_DAY} (на пользователя: {USER_MAX_REQUESTS_PER_DAY}/сутки)")
+        for st in GEMINI_ROUTER.stats():
+            if st["state"] != "closed":
+                lines.append(f"   ⛔️ {st['key']}/{st['model']}: {st['state']}, ещё ~{st['retry_in']:.0f} с")
+        lines.append("")
+    except Exception as e:
+        print("quota snapshot failed:", e)
+
+    st = RESPONSE_CACHE_STATS
+    lines.append(
+        f"🗂 Кэш ответов: hit {st['hits']} / miss {st['misses']}"
+        f" — сэкономлено ~{st['hits']} запросов и ~{st['saved_seconds']:.0f} с"
+    )
+    lines.append("")
+
+    lines += [
+        "🛠 Команды владельца:",
+        "• /report day — отчёт за сегодня (календарный день UTC, с 00:00)",
+        "• /report yesterday — за вчера целиком (UTC)",
+        "• /report week — отчёт за 7 дней",
+        "• /report 30d | /report 2026-01-01 2026-01-31 — произвольный период",
+        "• /forget <tg_id> [tg_id ...] — забыть пользователей (БД + память)",
+        "• /broadcast <текст> — рассылка всем (status | stop | resume <id>)",
+        "• /export [leads|events|messages|all] [период] — выгрузка CSV файлом",
+        "• /search <запрос> [p2] — поиск по перепискам",
+    ]
+
+    try:
+        await tg_app.bot.send_message(chat_id=int(OWNER_ID), text="\n".join(lines))
+    except Exception as e:
+        print("send_owner_report failed:", e)
+
+
+# ============================================================
+# ✅ Partitions & retention (messages, lead_events)
+# ============================================================
+PARTITIONED_TABLES = {
+    "messages": (
+        """
+        id BIGSERIAL,
+        tg_id BIGINT NOT NULL,
+        direction TEXT NOT NULL,
+        text TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, created_at)
+        """,
+        ("id",) + MESSAGES_COLUMNS,
+    ),
+    "lead_events": (
+        """
+        id BIGSERIAL,
+        tg_id BIGINT NULL,
+        lead_id BIGINT NULL,
+        event TEXT NOT NULL,
+        source TEXT NOT NULL,
+        meta JSONB NOT NULL DEFAULT '{}'::jsonb,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, created_at)
+        """,
+        ("id",) + LEAD_EVENTS_COLUMNS,
+    ),
+}
+PARTITION_NAME_RE = re.compile(r"^(?P<table>[a-z_]+)_y(?P<y>\d{4})m(?P<m>\d{2})$")
+
+
+def _month_start(d: date, shift: int = 0) -> date:
+    idx = d.year * 12 + (d.month - 1) + shift
+    return date(idx // 12, idx % 12 + 1, 1)
+
+
+async def _create_month_partition(conn, table: str, month: date):
+    name = f"{table}_y{month.year:04d}m{month.month:02d}"
+    try:
+        # savepoint: внутри транзакции ensure_partitioned_table ошибка иначе abort-ит всю транзакцию
+        async with conn.transaction():
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{month.isoformat()} 00:00:00+00') TO ('{_month_start(month, 1).isoformat()} 00:00:00+00')"
+            )
+    except asyncpg.PostgresError as e:
+        # например, строки этого месяца уже лежат в DEFAULT-партиции
+        print(f"partition {name} not created:", e)
+
+
+async def ensure_partitions(conn, months_ahead: int | None = None):
+    months_ahead = PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    this_month = _month_start(datetime.now(timezone.utc).date())
+    for table in PARTITIONED_TABLES:
+        for shift in range(-1, months_ahead + 1):
+            await _create_month_partition(conn, table, _month_start(this_month, shift))
+
+
+async def ensure_partitioned_table(conn, table: str):
+    """
+    Создаёт таблицу как RANGE (created_at) по месяцам. Если таблица уже есть
+    и она обычная — один раз переносит данные в партиционированную.
+    """
+    columns_ddl, columns = PARTITIONED_TABLES[table]
+    relkind = await conn.fetchval(
+        # relkind — тип "char", asyncpg отдаёт его как bytes; ::text, чтобы сравнивать со строкой
+        "SELECT c.relkind::text FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relname = $1 AND n.nspname = current_schema()",
+        table,
+    )
+    if relkind == "p":
+        return
+
+    cols = ", ".join(columns)
+    async with conn.transaction():
+        if relkind == "r":
+            await conn.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+        await conn.execute(f"CREATE TABLE {table} ({columns_ddl}) PARTITION BY RANGE (created_at)")
+        await conn.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+        if relkind == "r":
+            months = await conn.fetch(
+                f"SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC')::date AS m FROM {table}_legacy"
+            )
+            for r in months:
+                await _create_month_partition(conn, table, r["m"])
+        this_month = _month_start(datetime.now(timezone.utc).date())
+        for shift in range(-1, PARTITION_MONTHS_AHEAD + 1):
+            await _create_month_partition(conn, table, _month_start(this_month, shift))
+        if relkind == "r":
+            await conn.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {table}_legacy")
+            await conn.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)"
+            )
+            await conn.execute(f"DROP TABLE {table}_legacy")
+            print(f"✅ {table}: converted to monthly partitions", flush=True)
+
+
+async def enforce_retention(conn, months: int | None = None) -> list[str]:
+    """
+    Удаляет целиком помесячные партиции старше RETENTION_MONTHS (DROP TABLE,
+    без построчного DELETE). DEFAULT-партиция не трогается.
+    """
+    months = RETENTION_MONTHS if months is None else months
+    if months <= 0:
+        return []
+    cutoff = _month_start(datetime.now(timezone.utc).date(), -months)
+    rows = await conn.fetch(
+        """
+        SELECT c.relname AS name, p.relname AS parent
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = ANY($1::text[])
+        """,
+        list(PARTITIONED_TABLES),
+    )
+    dropped = []
+    for r in rows:
+        m = PARTITION_NAME_RE.match(r["name"])
+        if not m or m.group("table") != r["parent"]:
+            continue
+        month = date(int(m.group("y")), int(m.group("m")), 1)
+        if _month_start(month, 1) <= cutoff:
+            await conn.execute(f"DROP TABLE IF EXISTS {r['name']}")
+            dropped.append(r["name"])
+    if dropped:
+        print("retention: dropped partitions", dropped, flush=True)
+    return dropped
+
+
+async def _db_maintenance_loop():
+    while True:
+        try:
+            async with db_acquire() as conn:
+                await ensure_partitions(conn)
+                await enforce_retention(conn)
+        except Exception as e:
+            print("db maintenance failed:", e)
+        await asyncio.sleep(DB_MAINTENANCE_INTERVAL)
+
+
+def start_db_maintenance():
+    global DB_MAINTENANCE_TASK
+    DB_MAINTENANCE_TASK = asyncio.create_task(_db_maintenance_loop())
+
+
+async def stop_db_maintenance():
+    if DB_MAINTENANCE_TASK is not None:
+        DB_MAINTENANCE_TASK.cancel()
+        await asyncio.gather(DB_MAINTENANCE_TASK, return_exceptions=True)
+
+
+# ============================================================
+# ✅ Bulk forget
+# ============================================================
+def _purge_user_memory(tg_id: int):
+    invalidate_user_profile(tg_id)
+    RATE_LIMITER._leases.pop(f"user:{tg_id}", None)
+    RATE_LIMITER._lease_size.pop(f"user:{tg_id}", None)
+    if tg_app is None:
+        return
+    try:
+        tg_app.drop_user_data(tg_id)
+    except Exception:
+        ud = tg_app.user_data.get(tg_id)
+        if ud is not None:
+            ud.clear()
+
+
+async def forget_users(tg_ids: list[int]) -> int:
+    """
+    Полное удаление пользователей: пачками по FORGET_BATCH, каждая пачка — одна транзакция.
+    После каждой пачки чистится и память процесса (user_data, кэши, аренда лимитов).
+    """
+    ids = sorted({int(x) for x in tg_ids})
+    if not ids or not DB_POOL:
+        return 0
+
+    await log_flush_pending()
+
+    done = 0
+    for start_at in range(0, len(ids), FORGET_BATCH):
+        batch = ids[start_at:start_at + FORGET_BATCH]
+        async with db_acquire() as conn:
+            async with conn.transaction():
+                for table, col in (
+                    ("messages", "tg_id"), ("lead_events", "tg_id"), ("leads", "tg_id"), ("users", "tg_id"),
+                    ("conversations", "tg_id"), ("funnel_stages", "tg_id"), ("lead_funnel", "tg_id"),
+                    ("outbox", "chat_id"), ("broadcast_deliveries", "tg_id"),
+                ):
+                    await conn.execute(f"DELETE FROM {table} WHERE {col} = ANY($1::bigint[])", batch)
+                await conn.execute(
+                    "DELETE FROM rate_buckets WHERE key = ANY($1::text[])",
+                    [f"user:{x}" for x in batch],
+                )
+        await publish_invalidation("forget", batch)
+        done += len(batch)
+        await asyncio.sleep(0)
+    return done
+
+
+# ============================================================
+# ✅ Cross-process invalidation
+# ============================================================
+INVALIDATION_CHANNEL = "bot_invalidate"
+INVALIDATION_CHUNK = 500  # id в одном NOTIFY (payload ограничен 8000 байт)
+INVALIDATION_CONN: asyncpg.Connection | None = None
+
+
+def _apply_invalidation(kind: str, ids: list[int]):
+    for tg_id in ids:
+        if kind == "forget":
+            _purge_user_memory(tg_id)
+            continue
+        # lead: профиль и кэш стадии воронки перечитаются из БД
+        invalidate_user_profile(tg_id)
+        try:
+            ud = tg_app.user_data.get(tg_id) if tg_app is not None else None
+            if ud is not None:
+                ud.pop("funnel", None)
+        except Exception:
+            pass
+
+
+async def publish_invalidation(kind: str, ids: list[int]):
+    """
+    Сбрасывает память процесса по пользователям; в multi-process режиме
+    ещё и рассылает NOTIFY — состояние чата живёт в другом воркере.
+    """
+    _apply_invalidation(kind, ids)
+    if not MULTI_PROCESS or not DB_POOL:
+        return
+    try:
+        async with db_acquire() as conn:
+            for i in range(0, len(ids), INVALIDATION_CHUNK):
+                chunk = ",".join(str(x) for x in ids[i:i + INVALIDATION_CHUNK])
+                await conn.execute("SELECT pg_notify($1, $2)", INVALIDATION_CHANNEL, f"{WORKER_INDEX}|{kind}|{chunk}")
+    except Exception as e:
+        print("invalidation notify failed:", e)
+
+
+def _on_invalidation(conn, pid, channel, payload):
+    try:
+        origin, kind, raw = payload.split("|", 2)
+        if origin == str(WORKER_INDEX):
+            return
+        _apply_invalidation(kind, [int(x) for x in raw.split(",") if x])
+    except Exception as e:
+        print("invalidation payload error:", e)
+
+
+async def start_invalidation_listener():
+    global INVALIDATION_CONN
+    if not MULTI_PROCESS or INVALIDATION_CONN is not None:
+        return
+    # LISTEN держит соединение — отдельное, не из пула
+    INVALIDATION_CONN = await asyncpg.connect(DATABASE_URL)
+    await INVALIDATION_CONN.add_listener(INVALIDATION_CHANNEL, _on_invalidation)
+
+
+async def stop_invalidation_listener():
+    global INVALIDATION_CONN
+    if INVALIDATION_CONN is None:
+        return
+    try:
+        await INVALIDATION_CONN.close()
+    except Exception as e:
+        print("invalidation listener close failed:", e)
+    INVALIDATION_CONN = None
+
+
+# ============================================================
+# ✅ Outbox (confirmation messages)
+# ============================================================
+async def _outbox_claim() -> list:
+    """
+    Забирает пачку готовых к отправке сообщений и «арендует» их на минуту
+    (next_attempt_at сдвигается), чтобы другой процесс не отправил их повторно.
+    """
+    async with db_acquire() as conn:
+        return await conn.fetch(
+            """
+            UPDATE outbox SET next_attempt_at = now() + interval '60 seconds'
+            WHERE id IN (
+              SELECT id FROM outbox
+              WHERE sent_at IS NULL AND failed_at IS NULL AND next_attempt_at <= now()
+              ORDER BY id
+              LIMIT $1
+              FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, text, attempts
+            """,
+            OUTBOX_BATCH,
+        )
+
+
+async def _outbox_send(row) -> tuple[str, float | None, str | None]:
+    try:
+        await tg_app.bot.send_message(chat_id=int(row["chat_id"]), text=row["text"])
+        return "sent", None, None
+    except RetryAfter as e:
+        retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+        return "retry", retry_after, str(e)
+    except Forbidden as e:
+        return "failed", None, str(e)
+    except Exception as e:
+        if row["attempts"] + 1 >= OUTBOX_MAX_ATTEMPTS:
+            return "failed", None, str(e)
+        return "retry", min(3600.0, 5.0 * (2 ** row["attempts"])) * random.uniform(0.8, 1.2), str(e)
+
+
+async def outbox_drain_once() -> int:
+    rows = await _outbox_claim()
+    if not rows:
+        return 0
+    results = await asyncio.gather(*(_outbox_send(r) for r in rows))
+
+    sent = [r["id"] for r, (st, _, _) in zip(rows, results) if st == "sent"]
+    failed = [(r["id"], err) for r, (st, _, err) in zip(rows, results) if st == "failed"]
+    retry = [(r["id"], delay, err) for r, (st, delay, err) in zip(rows, results) if st == "retry"]
+    async with db_acquire() as conn:
+        if sent:
+            await conn.execute("UPDATE outbox SET sent_at = now(), attempts = attempts + 1 WHERE id = ANY($1::bigint[])", sent)
+        if failed:
+            await conn.executemany(
+                "UPDATE outbox SET failed_at = now(), attempts = attempts + 1, last_error = $2 WHERE id = $1",
+                failed,
+            )
+        if retry:
+            await conn.executemany(
+                """
+                UPDATE outbox
+                SET attempts = attempts + 1, last_error = $3,
+                    next_attempt_at = now() + make_interval(secs => $2)
+                WHERE id = $1
+                """,
+                retry,
+            )
+    for _id, err in failed:
+        print("outbox message failed:", err)
+    return len(rows)
+
+
+async def _outbox_loop():
+    while True:
+        try:
+            while await outbox_drain_once() >= OUTBOX_BATCH:
+                pass
+        except Exception as e:
+            print("outbox drain failed:", e)
+        try:
+            await asyncio.wait_for(OUTBOX_WAKEUP.wait(), OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        OUTBOX_WAKEUP.clear()
+
+
+def start_outbox_sender():
+    global OUTBOX_WAKEUP, OUTBOX_TASK
+    OUTBOX_WAKEUP = asyncio.Event()
+    OUTBOX_TASK = asyncio.create_task(_outbox_loop())
+
+
+async def stop_outbox_sender():
+    global OUTBOX_TASK
+    if OUTBOX_TASK is not None:
+        OUTBOX_TASK.cancel()
+        await asyncio.gather(OUTBOX_TASK, return_exceptions=True)
+    OUTBOX_TASK = None
+
+
+def outbox_wakeup():
+    if OUTBOX_WAKEUP is not None:
+        OUTBOX_WAKEUP.set()
+
+
+# ============================================================
+# ✅ Webhook worker pool (ordered per chat)
+# ============================================================
+def _update_shard_key(update: Update) -> int:
+    if update.effective_chat is not None:
+        return int(update.effective_chat.id)
+    if update.effective_user is not None:
+        return int(update.effective_user.id)
+    return int(update.update_id)
+
+
+def _webhook_seen(update_id: int) -> bool:
+    if update_id in WEBHOOK_SEEN:
+        return True
+    WEBHOOK_SEEN[update_id] = None
+    while len(WEBHOOK_SEEN) > WEBHOOK_DEDUP_MAX:
+        WEBHOOK_SEEN.popitem(last=False)
+    return False
+
+
+async def _webhook_worker(queue: asyncio.Queue):
+    while True:
+        update, update_type, enqueued_at = await queue.get()
+        lag = time.monotonic() - enqueued_at
+        WEBHOOK_STATS["lag_last"] = lag
+        WEBHOOK_STATS["lag_max"] = max(WEBHOOK_STATS["lag_max"], lag)
+        try:
+            async with WEBHOOK_UPDATE_SECONDS.time(update_type):
+                await tg_app.process_update(update)
+            WEBHOOK_STATS["processed"] += 1
+        except Exception as e:
+            WEBHOOK_STATS["failed"] += 1
+            print("process_update failed:", e)
+        finally:
+            queue.task_done()
+
+
+def start_webhook_workers():
+    for _ in range(max(1, WEBHOOK_WORKERS)):
+        q = asyncio.Queue(maxsize=WEBHOOK_QUEUE_MAX)
+        WEBHOOK_QUEUES.append(q)
+        WEBHOOK_WORKER_TASKS.append(asyncio.create_task(_webhook_worker(q)))
+
+
+async def stop_webhook_workers(timeout: float = 20.0):
+    """
+    Telegram уже получил «ok» — поэтому перед выходом дорабатываем очередь.
+    """
+    if WEBHOOK_QUEUES:
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in WEBHOOK_QUEUES)), timeout)
+        except asyncio.TimeoutError:
+            print("webhook queues not drained:", sum(q.qsize() for q in WEBHOOK_QUEUES), flush=True)
+    for t in WEBHOOK_WORKER_TASKS:
+        t.cancel()
+    await asyncio.gather(*WEBHOOK_WORKER_TASKS, return_exceptions=True)
+    WEBHOOK_WORKER_TASKS.clear()
+    WEBHOOK_QUEUES.clear()
+
+
+async def enqueue_update(update: Update, update_type: str = "unknown"):
+    # put() ждёт, если очередь воркера полна (backpressure на Telegram)
+    q = WEBHOOK_QUEUES[hash(_update_shard_key(update)) % len(WEBHOOK_QUEUES)]
+    await q.put((update, update_type, time.monotonic()))
+
+
+def webhook_queue_stats() -> dict:
+    return {
+        **WEBHOOK_STATS,
+        "workers": len(WEBHOOK_QUEUES),
+        "queue_depth": sum(q.qsize() for q in WEBHOOK_QUEUES),
+        "queue_depth_max": max((q.qsize() for q in WEBHOOK_QUEUES), default=0),
+    }
+
+
+# ============================================================
+# ✅ Conversation persistence (user_data -> Postgres)
+# ============================================================
+class PgConversationPersistence(BasePersistence):
+    """
+    Хранит только то, что нужно воронке ("introduced", история до MAX_TURNS, резюме),
+    одна строка JSONB на пользователя в таблице conversations.
+
+    — get_user_data() на старте ничего не грузит;
+    — refresh_user_data() лениво подтягивает состояние при первом апдейте;
+    — update_user_data() только копит «грязные» записи, они пишутся
+      одним executemany сразу после цикла обновления PTB.
+    """
+
+    KEYS = ("introduced", "history", "summary")
+
+    def __init__(self, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._loaded: set[int] = set()
+        self._pending: dict[int, str] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    def _compact(self, data: dict) -> str:
+        out = {k: data[k] for k in self.KEYS if k in data}
+        if "history" in out:
+            out["history"] = list(out["history"])[-(MAX_TURNS * 2):]
+        return json.dumps(out, ensure_ascii=False)
+
+    async def _write_pending(self):
+        self._flush_task = None
+        if not self._pending or not DB_POOL:
+            return
+        rows = list(self._pending.items())
+        self._pending.clear()
+        try:
+            async with db_acquire() as conn:
+                await conn.executemany(
+                    """
+                    INSERT INTO conversations (tg_id, data, updated_at)
+                    VALUES ($1, $2::jsonb, now())
+                    ON CONFLICT (tg_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                    """,
+                    rows,
+                )
+        except Exception as e:
+            print(f"conversations flush failed ({len(rows)} rows):", e)
+            for tg_id, data in rows:
+                self._pending.setdefault(tg_id, data)
+
+    # --- user_data ---
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded or not DB_POOL:
+            return
+        async with db_acquire() as conn:
+            raw = await conn.fetchval("SELECT data FROM conversations WHERE tg_id=$1", int(user_id))
+        self._loaded.add(user_id)
+        if raw:
+            stored = json.loads(raw)
+            for k, v in stored.items():
+                user_data.setdefault(k, v)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._loaded.add(user_id)
+        self._pending[int(user_id)] = self._compact(data)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._write_pending())
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded.discard(user_id)
+        self._pending.pop(int(user_id), None)
+        if DB_POOL:
+            async with db_acquire() as conn:
+                await conn.execute("DELETE FROM conversations WHERE tg_id=$1", int(user_id))
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
+
+    # --- не используется (bot_data / chat_data / callback_data / conversations) ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+
+# ============================================================
+# ✅ Broadcast (owner -> all users/leads)
+# ============================================================
+class TokenBucket:
+    """
+    Локальный async token bucket: acquire() ждёт, пока появится токен.
+    pause(sec) — общая пауза (например, retry_after от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+async def _broadcast_send(bucket: TokenBucket, chat_buckets: dict[int, TokenBucket], tg_id: int, text: str) -> tuple[str, str | None]:
+    chat_bucket = chat_buckets.setdefault(tg_id, TokenBucket(BROADCAST_PER_CHAT_RATE, 1))
+    err = "retries exhausted"
+    for _ in range(5):
+        await chat_bucket.acquire()
+        await bucket.acquire()
+        try:
+            await tg_app.bot.send_message(chat_id=tg_id, text=text)
+            return "sent", None
+        except RetryAfter as e:
+            bucket.pause(_retry_after_seconds(e))
+        except (Forbidden, BadRequest) as e:
+            return "failed", str(e)
+        except Exception as e:
+            err = str(e)
+            await asyncio.sleep(1)
+    return "failed", err
+
+
+async def _broadcast_save(broadcast_id: int, results: list[tuple[int, str, str | None]]):
+    if not results:
+        return
+    # забираем пачку до await: отправки продолжают дописывать в results, пока идёт executemany
+    batch = results[:]
+    results.clear()
+    try:
+        async with db_acquire() as conn:
+            await conn.executemany(
+                """
+                INSERT INTO broadcast_deliveries (broadcast_id, tg_id, status, error, updated_at)
+                VALUES ($1, $2, $3, $4, now())
+                ON CONFLICT (broadcast_id, tg_id) DO UPDATE SET
+                  status = EXCLUDED.status, error = EXCLUDED.error, updated_at = now()
+                """,
+                [(broadcast_id, tg_id, st, err) for tg_id, st, err in batch],
+            )
+    except BaseException:
+        results[:0] = batch
+        raise
+
+
+async def _owner_notify(text: str):
+    if not OWNER_ID or tg_app is None:
+        return
+    try:
+        await tg_app.bot.send_message(chat_id=int(OWNER_ID), text=text)
+    except Exception as e:
+        print("owner notify failed:", e)
+
+
+async def run_broadcast(broadcast_id: int):
+    """
+    Стримит получателей server-side курсором (users ∪ leads минус уже
+    обработанные в этой рассылке), шлёт через token bucket, статус каждого
+    получателя пишется пачками — прерванная рассылка продолжается с места остановки.
+    """
+    async with db_acquire() as conn:
+        text = await conn.fetchval("SELECT text FROM broadcasts WHERE id=$1", broadcast_id)
+        await conn.execute("UPDATE broadcasts SET status='running', started_at=COALESCE(started_at, now()) WHERE id=$1", broadcast_id)
+    if text is None:
+        return
+
+    bucket = TokenBucket(BROADCAST_RATE)
+    chat_buckets: dict[int, TokenBucket] = {}
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    pending: list[tuple[int, str, str | None]] = []
+    counts = {"sent": 0, "failed": 0}
+    tasks: set[asyncio.Task] = set()
+    t0 = time.monotonic()
+    last_progress = t0
+
+    async def one(tg_id: int):
+        try:
+            st, err = await _broadcast_send(bucket, chat_buckets, tg_id, text)
+            chat_buckets.pop(tg_id, None)
+            counts[st] += 1
+            pending.append((tg_id, st, err))
+        finally:
+            sem.release()
+
+    recipients_sql = """
+        SELECT r.tg_id FROM (
+          SELECT tg_id FROM users
+          UNION
+          SELECT tg_id FROM leads WHERE tg_id IS NOT NULL
+        ) AS r
+        WHERE NOT EXISTS (
+          SELECT 1 FROM broadcast_deliveries d
+          WHERE d.broadcast_id = $1 AND d.tg_id = r.tg_id AND d.status IN ('sent', 'failed')
+        )
+        ORDER BY r.tg_id
+    """
+
+    try:
+        async with db_acquire() as conn:
+            total = await conn.fetchval(f"SELECT count(*) FROM ({recipients_sql}) AS x", broadcast_id)
+            await _owner_notify(f"📣 Рассылка #{broadcast_id}: старт, получателей {total}")
+            async with conn.transaction(readonly=True):
+                cur = await conn.cursor(recipients_sql, broadcast_id)
+                while True:
+                    rows = await cur.fetch(500)
+                    if not rows:
+                        break
+                    for r in rows:
+                        await sem.acquire()
+                        t = asyncio.create_task(one(int(r["tg_id"])))
+                        tasks.add(t)
+                        t.add_done_callback(tasks.discard)
+                        if len(pending) >= 100:
+                            await _broadcast_save(broadcast_id, pending)
+                        now = time.monotonic()
+                        if now - last_progress >= BROADCAST_PROGRESS_EVERY:
+                            last_progress = now
+                            done = counts["sent"] + counts["failed"]
+                            await _owner_notify(
+                                f"📣 #{broadcast_id}: {done}/{total} (✅ {counts['sent']}, ❌ {counts['failed']}), "
+                                f"{done / max(now - t0, 0.001):.1f} msg/s"
+                            )
+        await asyncio.gather(*tasks)
+        await _broadcast_save(broadcast_id, pending)
+    except asyncio.CancelledError:
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await _broadcast_save(broadcast_id, pending)
+        if BROADCAST_SHUTTING_DOWN:
+            # статус остаётся running — продолжим автоматически после рестарта
+            raise
+        async with db_acquire() as conn:
+            await conn.execute("UPDATE broadcasts SET status='paused' WHERE id=$1", broadcast_id)
+        await _owner_notify(f"⏸ Рассылка #{broadcast_id} остановлена. Продолжить: /broadcast resume {broadcast_id}")
+        raise
+
+    elapsed = time.monotonic() - t0
+    async with db_acquire() as conn:
+        await conn.execute("UPDATE broadcasts SET status='done', finished_at=now() WHERE id=$1", broadcast_id)
+    done = counts["sent"] + counts["failed"]
+    await _owner_notify(
+        f"✅ Рассылка #{broadcast_id} завершена: ✅ {counts['sent']}, ❌ {counts['failed']} "
+        f"за {elapsed:.0f} с ({done / max(elapsed, 0.001):.1f} msg/s)"
+    )
+
+
+def owns_broadcasts() -> bool:
+    # /broadcast stop|resume приходят в воркер чата владельца, а BROADCAST_TASK у каждого процесса свой —
+    # поэтому и после рестарта рассылку поднимает тот же воркер
+    if WORKER_INDEX is None:
+        return True
+    if OWNER_ID and str(OWNER_ID).lstrip("-").isdigit():
+        return WORKER_INDEX == _worker_for_chat(int(OWNER_ID))
+    return IS_PRIMARY
+
+
+async def resume_interrupted_broadcasts():
+    """
+    После рестарта продолжаем рассылку, которая была в статусе running.
+    """
+    if not DB_POOL or not owns_broadcasts():
+        return
+    async with db_acquire() as conn:
+        broadcast_id = await conn.fetchval("SELECT id FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1")
+    if broadcast_id is not None:
+        _start_broadcast_task(int(broadcast_id))
+
+
+async def stop_broadcast():
+    global BROADCAST_SHUTTING_DOWN
+    BROADCAST_SHUTTING_DOWN = True
+    if BROADCAST_TASK is not None and not BROADCAST_TASK.done():
+        BROADCAST_TASK.cancel()
+        await asyncio.gather(BROADCAST_TASK, return_exceptions=True)
+
+
+def _start_broadcast_task(broadcast_id: int) -> bool:
+    global BROADCAST_TASK
+    if BROADCAST_TASK is not None and not BROADCAST_TASK.done():
+        return False
+    BROADCAST_TASK = asyncio.create_task(run_broadcast(broadcast_id))
+    return True
+
+
+async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not OWNER_ID or str(update.effective_user.id) != str(OWNER_ID):
+        return
+    if not DB_POOL:
+        await update.message.reply_text("DB not ready")
+        return
+
+    args = context.args or []
+    sub = args[0].lower() if args else ""
+
+    if sub == "stop":
+        if BROADCAST_TASK is not None and not BROADCAST_TASK.done():
+            BROADCAST_TASK.cancel()
+        else:
+            await update.message.reply_text("Нет активной рассылки.")
+        return
+
+    if sub == "resume":
+        if len(args) < 2 or not args[1].isdigit():
+            await update.message.reply_text("Формат: /broadcast resume <id>")
+            return
+        if not _start_broadcast_task(int(args[1])):
+            await update.message.reply_text("Уже идёт другая рассылка. Остановить: /broadcast stop")
+        return
+
+    if sub == "status":
+        async with db_acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT b.id, b.status, b.created_at,
+                       count(*) FILTER (WHERE d.status = 'sent') AS sent,
+                       count(*) FILTER (WHERE d.status = 'failed') AS failed
+                FROM broadcasts b
+                LEFT JOIN broadcast_deliveries d ON d.broadcast_id = b.id
+                GROUP BY b.id
+                ORDER BY b.id DESC
+                LIMIT 5
+                """
+            )
+        lines = [f"#{r['id']} {r['status']} — ✅ {r['sent']}, ❌ {r['failed']} ({r['created_at']:%Y-%m-%d %H:%M})" for r in rows]
+        await update.message.reply_text("\n".join(lines) or "Рассылок ещё не было.")
+        return
+
+    # текст — всё после команды, с переносами строк
+    text = (update.message.text or "").partition(" ")[2].strip()
+    if not text:
+        await update.message.reply_text(
+            "Формат: /broadcast <текст>\n"
+            "/broadcast status | /broadcast stop | /broadcast resume <id>"
+        )
+        return
+    if BROADCAST_TASK is not None and not BROADCAST_TASK.done():
+        await update.message.reply_text("Уже идёт рассылка. Остановить: /broadcast stop")
+        return
+
+    async with db_acquire() as conn:
+        broadcast_id = await conn.fetchval("INSERT INTO broadcasts (text) VALUES ($1) RETURNING id", text)
+    _start_broadcast_task(int(broadcast_id))
+
+
+# ============================================================
+# ✅ OWNER: /forget <tg_id>
+# ============================================================
+async def forget_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not OWNER_ID or str(update.effective_user.id) != str(OWNER_ID):
+        return
+
+    if not context.args:
+        await update.message.reply_text("Формат: /forget <tg_id> [tg_id ...]\nПример: /forget 6624060143")
+        return
+
+    raw_ids = " ".join(context.args).replace(",", " ").split()
+    if not all(x.isdigit() for x in raw_ids):
+        await update.message.reply_text("Нужен tg_id числом. Пример: /forget 6624060143")
+        return
+
+    tg_ids = [int(x) for x in raw_ids]
+
+    if not DB_POOL:
+        await update.message.reply_text("DB not ready")
+        return
+
+    if len(tg_ids) == 1:
+        await forget_users(tg_ids)
+        await update.message.reply_text(f"✅ Готово. Пользователь {tg_ids[0]} полностью «забыт».")
+        return
+
+    async def run():
+        try:
+            n = await forget_users(tg_ids)
+            await _owner_notify(f"✅ Готово. Забыто пользователей: {n}.")
+        except Exception as e:
+            await _owner_notify(f"⚠️ /forget остановлен с ошибкой: {e}")
+
+    task = asyncio.create_task(run())
+    FORGET_TASKS.add(task)
+    task.add_done_callback(FORGET_TASKS.discard)
+    await update.message.reply_text(f"⏳ Удаляю {len(set(tg_ids))} пользователей в фоне, пришлю итог.")
+
+
+# ============================================================
+# ✅ Export (CSV)
+# ============================================================
+# ORDER BY id: для leads — PK, для партиций — PK (id, created_at) + Merge Append, без сортировки в памяти
+EXPORT_TABLES = {
+    "leads": (
+        """
+        SELECT id, tg_id, source, name_from_form, niche_from_form, contact_from_form,
+               payload::text, idempotency_key, created_at
+        FROM leads WHERE created_at >= $1 AND created_at < $2 ORDER BY id
+        """,
+        ("id", "tg_id", "source", "name_from_form", "niche_from_form", "contact_from_form",
+         "payload", "idempotency_key", "created_at"),
+    ),
+    "events": (
+        """
+        SELECT id, tg_id, lead_id, event, source, meta::text, created_at
+        FROM lead_events WHERE created_at >= $1 AND created_at < $2 ORDER BY id
+        """,
+        ("id",) + LEAD_EVENTS_COLUMNS,
+    ),
+    "messages": (
+        """
+        SELECT id, tg_id, direction, text, created_at
+        FROM messages WHERE created_at >= $1 AND created_at < $2 ORDER BY id
+        """,
+        ("id",) + MESSAGES_COLUMNS,
+    ),
+}
+
+
+def _csv_value(v):
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.astimezone(timezone.utc).isoformat()
+    if isinstance(v, str) and v[:1] in ("=", "+", "-", "@"):
+        # текст пользователей не должен исполняться как формула в Excel/Sheets
+        return "'" + v
+    return v
+
+
+async def export_csv_chunks(table: str, d_from: date, d_to: date):
+    """
+    Async-генератор CSV-чанков (bytes, ~EXPORT_CHUNK_BYTES) за период включительно.
+    Строки идут серверным курсором — в памяти не больше prefetch + один чанк.
+    """
+    sql, header = EXPORT_TABLES[table]
+    start = datetime(d_from.year, d_from.month, d_from.day, tzinfo=timezone.utc)
+    end = datetime(d_to.year, d_to.month, d_to.day, tzinfo=timezone.utc) + timedelta(days=1)
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    # заголовок — отдельным первым чанком (его повторяют части файла)
+    yield buf.getvalue().encode("utf-8")
+    buf.seek(0)
+    buf.truncate()
+    async with db_acquire() as conn:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            async for rec in conn.cursor(sql, start, end, prefetch=EXPORT_PREFETCH):
+                writer.writerow([_csv_value(v) for v in rec])
+                if buf.tell() >= EXPORT_CHUNK_BYTES:
+                    yield buf.getvalue().encode("utf-8")
+                    buf.seek(0)
+                    buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+async def _send_export_part(tmp, filename: str):
+    tmp.seek(0)
+    await tg_app.bot.send_document(chat_id=int(OWNER_ID), document=tmp, filename=filename, write_timeout=120)
+    tmp.close()
+
+
+async def send_export_to_owner(tables: list[str], d_from: date, d_to: date):
+    """
+    Пишет CSV во временный файл и отправляет документом; больше
+    EXPORT_PART_BYTES — режет на части (у Bot API лимит 50 МБ на файл),
+    заголовок повторяется в каждой части.
+    """
+    for table in tables:
+        base = f"{table}_{d_from.isoformat()}_{d_to.isoformat()}"
+        chunks = export_csv_chunks(table, d_from, d_to)
+        tmp = None
+        part = 0
+        try:
+            header = "\ufeff".encode("utf-8") + await anext(chunks)
+            async for chunk in chunks:
+                if tmp is None or tmp.tell() + len(chunk) > EXPORT_PART_BYTES:
+                    if tmp is not None:
+                        await _send_export_part(tmp, f"{base}_part{part}.csv")
+                    tmp = tempfile.TemporaryFile()
+                    tmp.write(header)
+                    part += 1
+                tmp.write(chunk)
+            if tmp is None:
+                await _owner_notify(f"📭 {table}: за {d_from}…{d_to} строк нет.")
+                continue
+            await _send_export_part(tmp, f"{base}.csv" if part == 1 else f"{base}_part{part}.csv")
+        finally:
+            if tmp is not None:
+                tmp.close()
+            await chunks.aclose()
+
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not OWNER_ID or str(update.effective_user.id) != str(OWNER_ID):
+        return
+
+    args = list(context.args or [])
+    what = args.pop(0).lower() if args and args[0].lower() in (*EXPORT_TABLES, "all") else "all"
+    period = " ".join(args) or "day"
+    try:
+        d_from, d_to = _report_range(period)
+    except ValueError:
+        await update.message.reply_text(
+            "Формат: /export [leads|events|messages|all] [day|week|30d|YYYY-MM-DD YYYY-MM-DD]"
+        )
+        return
+
+    if not DB_POOL:
+        await update.message.reply_text("DB not ready")
+        return
+
+    tables = list(EXPORT_TABLES) if what == "all" else [what]
+
+    async def run():
+        try:
+            await send_export_to_owner(tables, d_from, d_to)
+        except Exception as e:
+            await _owner_notify(f"⚠️ /export остановлен с ошибкой: {e}")
+
+    task = asyncio.create_task(run())
+    EXPORT_TASKS.add(task)
+    task.add_done_callback(EXPORT_TASKS.discard)
+    await update.message.reply_text(f"⏳ Готовлю выгрузку {', '.join(tables)} за {d_from}…{d_to}.")
+
+
+# ============================================================
+# ✅ Search (messages full-text)
+# ============================================================
+SEARCH_PAGE_RE = re.compile(r"^p(\d{1,4})$", re.IGNORECASE)
+
+
+@instrumented
+async def search_conversations(query: str, page: int = 1, page_size: int | None = None) -> tuple[int, bool, list]:
+    """
+    Ищет по messages.tsv (GIN), группирует по tg_id: лучший ранг, число совпадений,
+    сниппет лучшего сообщения и последняя заявка пользователя.
+    Ранжируются только SEARCH_MAX_HITS самых свежих совпадений (кандидаты берутся
+    по idx_messages_created / GIN без подсчёта ранга для всех строк); truncated —
+    совпадений было больше, и total/hits посчитаны только по свежим.
+    ts_headline считается только для строк текущей страницы.
+    """
+    page_size = page_size or SEARCH_PAGE_SIZE
+    offset = (max(1, page) - 1) * page_size
+    async with db_acquire() as conn:
+        rows = await conn.fetch(
+            """
+            WITH q AS (SELECT websearch_to_tsquery('russian', $1) AS query),
+            candidates AS (
+              SELECT m.tg_id, m.id, m.created_at, m.tsv
+              FROM messages m, q
+              WHERE m.tsv @@ q.query
+              ORDER BY m.created_at DESC
+              LIMIT $4 + 1
+            ),
+            hits AS (
+              SELECT c.tg_id, c.id, c.created_at, ts_rank_cd(c.tsv, q.query) AS rank
+              FROM (SELECT * FROM candidates ORDER BY created_at DESC LIMIT $4) c, q
+            ),
+            per_user AS (
+              SELECT tg_id, count(*) AS hits, max(rank) AS best_rank, max(created_at) AS last_at,
+                     (array_agg(id ORDER BY rank DESC, created_at DESC))[1] AS best_id,
+                     (array_agg(created_at ORDER BY rank DESC, created_at DESC))[1] AS best_at
+              FROM hits
+              GROUP BY tg_id
+            ),
+            paged AS (
+              SELECT *, count(*) OVER () AS total, (SELECT count(*) FROM candidates) > $4 AS truncated
+              FROM per_user
+              ORDER BY best_rank DESC, last_at DESC
+              LIMIT $2 OFFSET $3
+            )
+            SELECT p.tg_id, p.hits, p.best_rank, p.last_at, p.total, p.truncated,
+                   ts_headline('russian', m.text, q.query,
+                               'StartSel=«, StopSel=», MaxWords=25, MinWords=8, MaxFragments=2') AS snippet,
+                   u.first_name, u.username,
+                   l.id AS lead_id, l.source AS lead_source, l.name_from_form, l.niche_from_form,
+                   l.contact_from_form, l.created_at AS lead_at
+            FROM paged p
+            CROSS JOIN q
+            JOIN messages m ON m.id = p.best_id AND m.created_at = p.best_at
+            LEFT JOIN users u ON u.tg_id = p.tg_id
+            LEFT JOIN LATERAL (
+              SELECT id, source, name_from_form, niche_from_form, contact_from_form, created_at
+              FROM leads WHERE tg_id = p.tg_id
+              ORDER BY id DESC LIMIT 1
+            ) l ON true
+            ORDER BY p.best_rank DESC, p.last_at DESC
+            """,
+            query, page_size, offset, SEARCH_MAX_HITS,
+        )
+    total = int(rows[0]["total"]) if rows else 0
+    truncated = bool(rows[0]["truncated"]) if rows else False
+    return total, truncated, rows
+
+
+def _search_row_dict(r) -> dict:
+    return {
+        "tgId": r["tg_id"],
+        "hits": r["hits"],
+        "rank": round(float(r["best_rank"]), 4),
+        "lastAt": r["last_at"].isoformat(),
+        "snippet": r["snippet"],
+        "firstName": r["first_name"],
+        "username": r["username"],
+        "lead": None if r["lead_id"] is None else {
+            "id": r["lead_id"],
+            "source": r["lead_source"],
+            "name": r["name_from_form"],
+            "niche": r["niche_from_form"],
+            "contact": r["contact_from_form"],
+            "createdAt": r["lead_at"].isoformat(),
+        },
+    }
+
+
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not OWNER_ID or str(update.effective_user.id) != str(OWNER_ID):
+        return
+
+    args = list(context.args or [])
+    page = 1
+    if args and SEARCH_PAGE_RE.match(args[-1]):
+        page = int(SEARCH_PAGE_RE.match(args.pop())[1])
+    query = " ".join(args).strip()
+    if not query:
+        await update.message.reply_text('Формат: /search <запрос> [p2]\nПример: /search "салон красоты" бюджет')
+        return
+
+    if not DB_POOL:
+        await update.message.reply_text("DB not ready")
+        return
+
+    total, truncated, rows = await search_conversations(query, page)
+    if not rows:
+        await update.message.reply_text("🔎 Ничего не найдено." if page == 1 else "🔎 Больше результатов нет.")
+        return
+
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    lines = [f"🔎 «{query}» — пользователей: {total}{'+' if truncated else ''}, стр. {page}/{pages}", ""]
+    if truncated:
+        lines[-1:] = [f"⚠️ Совпадений больше {SEARCH_MAX_HITS} — показаны лучшие по рангу, уточните запрос.", ""]
+    for r in rows:
+        who = r["first_name"] or "—"
+        if r["username"]:
+            who += f" (@{r['username']})"
+        lines.append(f"👤 {who} · tg_id {r['tg_id']} · совпадений {r['hits']} · {r['last_at']:%Y-%m-%d}")
+        if r["lead_id"] is not None:
+            lines.append(
+                f"   🧾 заявка #{r['lead_id']} ({r['lead_source']}, {r['lead_at']:%Y-%m-%d}): "
+                f"{r['niche_from_form'] or '—'} / {r['contact_from_form'] or '—'}"
+            )
+        lines.append(f"   💬 {(r['snippet'] or '').replace(chr(10), ' ')}")
+        lines.append("")
+    if page < pages:
+        lines.append(f"Дальше: /search {query} p{page + 1}")
+
+    await update.message.reply_text("\n".join(lines)[:TG_MAX_MESSAGE_LEN])
+
+
+# ============================================================
+# ✅ Funnel state machine (lead_funnel)
+# ============================================================
+# new -> choose_service -> goal -> budget -> done
+SERVICE_PICK_RE = re.compile(r"^\s*([1-4])\s*[).,!]?\s*$")
+BUDGET_RE = re.compile(
+    r"(\d[\d\s.,]*\s*(k|к|тыс|000|\$|usd|долл|€|eur|евро|₽|руб|р\b|лар|gel|₾))|(\$\s*\d)|(\d{3,})",
+    re.IGNORECASE,
+)
+# ответ на вопрос о цели: варианты из SERVICE_GOAL_QUESTIONS и явные формулировки цели
+GOAL_RE = re.compile(
+    r"заяв|продаж|клиент|узнава|контент|подписчик|креатив|сайт|mini\s*app|мини.?ап|интеграц|crm|црм|"
+    r"оплат|бот|реклам|конверс|цель|хочу|хотим|нужн|чтобы",
+    re.IGNORECASE,
+)
+QUESTION_START_RE = re.compile(r"^\s*(а\s+)?(как|сколько|что|почему|зачем|когда|где|какой|какая|какие|можно|есть ли)\b", re.IGNORECASE)
+
+
+@instrumented
+async def db_get_funnel(tg_id: int) -> dict | None:
+    if not DB_POOL:
+        return None
+    async with db_acquire() as conn:
+        row = await conn.fetchrow("SELECT stage, service FROM lead_funnel WHERE tg_id=$1", int(tg_id))
+    if not row:
+        return None
+    return {"stage": row["stage"], "service": row["service"]}
+
+
+@instrumented
+async def db_set_funnel(tg_id: int, stage: str, service: int | None = None, budget: str | None = None):
+    if not DB_POOL:
+        return
+    async with db_acquire() as conn:
+        await conn.execute(
             """
+            INSERT INTO lead_funnel (tg_id, stage, service, budget, updated_at)
+            VALUES ($1, $2, $3, $4, now())
+            ON CONFLICT (tg_id) DO UPDATE SET
+              stage = EXCLUDED.stage,
+              service = COALESCE(EXCLUDED.service, lead_funnel.service),
+              budget = COALESCE(EXCLUDED.budget, lead_funnel.budget),
+              updated_at = now()
+            """,
+            int(tg_id), stage, service, budget,
         )
 
-    by_tg: dict[int, list[str]] = {}
-    for r in ev_rows:
-        if r["tg_id"] is None:
-            continue
-        by_tg.setdefault(int(r["tg_id"]), []).append(r["source"] or "-")
-
-    lines = [f"📊 Отчёт за {period}", f"— пользователей с событиями: {len(by_tg)}", ""]
-    for tg_id, chain in list(by_tg.items())[:60]:
-        lines.append(f"👤 tg_id={tg_id}")
-        lines.append(f"   путь: {' → '.join(chain)}")
-        lines.append("")
 
-    lines += [
-        "🛠 Команды владельца:",
-        "• /report day — отчёт за сутки",
-        "• /report week — отчёт за 7 дней",
-        "• /forget <tg_id> — забыть пользователя (БД + память)",
-    ]
+async def get_funnel(tg_id: int, user_data: dict) -> dict:
+    funnel = user_data.get("funnel")
+    if funnel is None:
+        funnel = await db_get_funnel(tg_id) or {"stage": "new", "service": None}
+        user_data["funnel"] = funnel
+    return funnel
 
-    try:
-        await tg_app.bot.send_message(chat_id=int(OWNER_ID), text="\n".join(lines))
-    except Exception as e:
-        print("send_owner_report failed:", e)
 
+async def set_funnel(tg_id: int, user_data: dict, stage: str, service: int | None = None, budget: str | None = None):
+    funnel = user_data.setdefault("funnel", {"stage": "new", "service": None})
+    funnel["stage"] = stage
+    if service is not None:
+        funnel["service"] = service
+    await db_set_funnel(tg_id, stage, service, budget)
 
-# ============================================================
-# ✅ OWNER: /forget <tg_id>
-# ============================================================
-async def forget_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not OWNER_ID or str(update.effective_user.id) != str(OWNER_ID):
-        return
 
-    if not context.args:
-        await update.message.reply_text("Формат: /forget <tg_id>\nПример: /forget 6624060143")
-        return
+def _parse_budget(text: str) -> str | None:
+    if "?" in text or not BUDGET_RE.search(text):
+        return None
+    return text.strip()[:200]
 
-    tg_id_str = context.args[0].strip()
-    if not tg_id_str.isdigit():
-        await update.message.reply_text("Нужен tg_id числом. Пример: /forget 6624060143")
-        return
 
-    tg_id = int(tg_id_str)
+def _is_goal_answer(text: str, service: int, history: list[dict]) -> bool:
+    # только короткий ответ прямо на наш вопрос о цели; вопросы и прочий свободный текст — в Gemini
+    if SERVICE_GOAL_QUESTIONS[service] not in _last_model_text(history):
+        return False
+    if "?" in text or len(text) > 300 or QUESTION_START_RE.match(text):
+        return False
+    return bool(GOAL_RE.search(text))
 
-    if not DB_POOL:
-        await update.message.reply_text("DB not ready")
-        return
 
-    async with DB_POOL.acquire() as conn:
-        await conn.execute("DELETE FROM messages WHERE tg_id=$1", tg_id)
-        await conn.execute("DELETE FROM lead_events WHERE tg_id=$1", tg_id)
-        await conn.execute("DELETE FROM leads WHERE tg_id=$1", tg_id)
-        await conn.execute("DELETE FROM users WHERE tg_id=$1", tg_id)
+def _last_model_text(history: list[dict]) -> str:
+    for turn in reversed(history):
+        if turn.get("role") == "model":
+            return _turn_text(turn)
+    return ""
 
-    try:
-        ud = context.application.user_data.get(tg_id)
-        if ud is not None:
-            ud.clear()
-    except Exception:
-        pass
 
-    await update.message.reply_text(f"✅ Готово. Пользователь {tg_id} полностью «забыт».")
+async def funnel_try_local(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> bool:
+    """
+    Фиксированные шаги воронки без вызова модели:
+    цифра 1–4 -> вопрос о цели, явный ответ о цели -> вопрос о бюджете,
+    сумма -> финальный текст. Всё остальное (вопросы, свободный текст) -> False.
+    """
+    tg_id = int(update.effective_user.id)
+    funnel = await get_funnel(tg_id, context.user_data)
+    stage = funnel.get("stage") or "new"
+    history = context.user_data.get("history", [])
+    reply = None
+
+    m = SERVICE_PICK_RE.match(text)
+    if m and stage in ("choose_service", "goal"):
+        service = int(m.group(1))
+        title, _ = SERVICES[service]
+        reply = f"Отлично, {title} ✅\n{SERVICE_GOAL_QUESTIONS[service]}"
+        await set_funnel(tg_id, context.user_data, "goal", service=service)
+        await db_log_event(event="service_selected", source="bot", tg_id=tg_id, meta={"service": service, "title": title})
+
+    elif stage in ("choose_service", "goal", "budget") and (
+        stage == "budget" or "сумму" in _last_model_text(history)
+    ) and _parse_budget(text):
+        budget = _parse_budget(text)
+        reply = FINAL_TEXT
+        await set_funnel(tg_id, context.user_data, "done", budget=budget)
+        await db_log_event(event="budget", source="bot", tg_id=tg_id, meta={"budget": budget, "service": funnel.get("service")})
+
+    elif stage == "goal" and funnel.get("service") and _is_goal_answer(text, int(funnel["service"]), history):
+        _, kind = SERVICES[int(funnel["service"])]
+        reply = f"Поняла ✅\n{BUDGET_QUESTIONS[kind]}"
+        await set_funnel(tg_id, context.user_data, "budget")
+        await db_log_event(event="goal", source="bot", tg_id=tg_id, meta={"text_preview": text[:160]})
+
+    if reply is None:
+        return False
+
+    await update.message.reply_text(reply)
+    await db_log_message(tg_id, "out", reply)
+
+    history.append({"role": "user", "parts": [{"text": text}]})
+    history.append({"role": "model", "parts": [{"text": reply}]})
+    history, summary = compact_history(history, context.user_data.get("summary", ""))
+    context.user_data["history"] = history
+    context.user_data["summary"] = summary
+    return True
 
 
 # ============================================================
@@ -369,13 +3424,14 @@ async def forget_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["introduced"] = True
     context.user_data["history"] = []
+    context.user_data["summary"] = ""
 
     user = update.effective_user
     args = context.args or []
 
     if args and args[0].lower() in ("ig", "insta", "instagram"):
         await db_log_event(event="start", source="instagram", tg_id=int(user.id), meta={"from": "ig_deeplink"})
-        name_form, niche_form = await db_get_latest_miniapp_profile(int(user.id))
+        name_form, niche_form, _ = await get_user_profile(int(user.id))
         if niche_form:
             final_name = (name_form or user.first_name or "друг").strip()
             await update.message.reply_text(
@@ -383,13 +3439,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Зафиксировала: ниша — {niche_form}.\n\n"
                 f"{POST_MINIAPP_TEXT}"
             )
+            await set_funnel(int(user.id), context.user_data, "choose_service")
         else:
             await update.message.reply_text(IG_WELCOME_TEXT)
         return
 
     await db_log_event(event="start", source="telegram", tg_id=int(user.id), meta={"from": "direct_start"})
 
-    name_form, niche_form = await db_get_latest_miniapp_profile(int(user.id))
+    name_form, niche_form, _ = await get_user_profile(int(user.id))
     if niche_form:
         final_name = (name_form or user.first_name or "друг").strip()
         await update.message.reply_text(
@@ -397,6 +3454,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Зафиксировала: ниша — {niche_form}.\n\n"
             f"{POST_MINIAPP_TEXT}"
         )
+        await set_funnel(int(user.id), context.user_data, "choose_service")
     else:
         await update.message.reply_text(WELCOME_TEXT)
 
@@ -405,10 +3463,7 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not OWNER_ID or str(update.effective_user.id) != str(OWNER_ID):
         return
 
-    period = (context.args[0] if context.args else "day").lower()
-    if period not in ("day", "week"):
-        period = "day"
-
+    period = (" ".join(context.args) if context.args else "day").lower()
     await send_owner_report(period)
 
 
@@ -418,19 +3473,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         return
 
-    allowed, reason = _check_and_update_global_limit()
-    if not allowed:
-        await update.message.reply_text(reason)
-        return
-
     await db_log_message(int(user.id), "in", text)
     await db_log_event(event="message", source="bot", tg_id=int(user.id), meta={"text_preview": text[:160]})
 
     if not context.user_data.get("introduced"):
         context.user_data["introduced"] = True
         context.user_data["history"] = []
+        context.user_data["summary"] = ""
 
-        name_form, niche_form = await db_get_latest_miniapp_profile(int(user.id))
+        name_form, niche_form, _ = await get_user_profile(int(user.id))
         if niche_form:
             final_name = (name_form or user.first_name or "друг").strip()
             await update.message.reply_text(
@@ -438,52 +3489,175 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Зафиксировала: ниша — {niche_form}.\n\n"
                 f"{POST_MINIAPP_TEXT}"
             )
+            await set_funnel(int(user.id), context.user_data, "choose_service")
         else:
             await update.message.reply_text(WELCOME_TEXT)
         return
 
-    # ===== Gemini flow =====
-    try:
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    except Exception:
-        pass
+    chat_id = update.effective_chat.id
+    pending = COALESCE_PENDING.get(chat_id)
+    if pending is not None:
+        # ход ещё собирается (или ждёт, пока договорит предыдущий ответ) — дописываем в него
+        pending["texts"].append(text)
+        pending["update"] = update
+        pending["wake"].set()
+        MESSAGES_COALESCED.inc()
+        return
 
-    name_form, niche_form = await db_get_latest_miniapp_profile(int(user.id))
-    niche_db = await db_get_user_niche(int(user.id))
+    lock = _chat_lock(chat_id)
+    local_tried = not lock.locked()
+    if local_tried:
+        async with lock:
+            # ===== фиксированные шаги воронки — локально =====
+            if await funnel_try_local(update, context, text):
+                return
+
+            if COALESCE_WINDOW <= 0:
+                try:
+                    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+                except Exception:
+                    pass
+                await answer_with_gemini(update, context, text)
+                return
+
+    # предыдущий ответ ещё в работе или нужно подождать окно склейки:
+    # всё, что придёт до освобождения чата, уйдёт одним ходом после него
+    COALESCE_PENDING[chat_id] = {
+        "texts": [text], "update": update, "wake": asyncio.Event(), "local_tried": local_tried,
+    }
+    # update= — PTB сохранит user_data в persistence, когда задача закончится
+    context.application.create_task(_coalesce_and_answer(chat_id, context), update=update)
 
-    prefix = ""
-    if niche_form:
-        prefix += f"(Mini App уже заполнен: ДА. Имя из формы: {name_form or '-'}, Ниша из формы: {niche_form})\n"
-    else:
-        prefix += "(Mini App уже заполнен: НЕТ)\n"
 
-    if niche_db:
-        prefix += f"(Ниша/род деятельности пользователя: {niche_db})\n"
+# ============================================================
+# ✅ Message coalescing
+# ============================================================
+COALESCE_PENDING: dict[int, dict] = {}
+COALESCE_LOCKS: dict[int, asyncio.Lock] = {}
 
-    history = context.user_data.get("history", [])
-    history.append({"role": "user", "parts": [{"text": prefix + text}]})
-    history = history[-(MAX_TURNS * 2):]
 
+def _chat_lock(chat_id: int) -> asyncio.Lock:
+    lock = COALESCE_LOCKS.get(chat_id)
+    if lock is None:
+        if len(COALESCE_LOCKS) > 10000:
+            for k in [k for k, v in COALESCE_LOCKS.items() if not v.locked() and k not in COALESCE_PENDING]:
+                COALESCE_LOCKS.pop(k, None)
+        lock = COALESCE_LOCKS[chat_id] = asyncio.Lock()
+    return lock
+
+
+async def _keep_typing(bot, chat_id: int):
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Exception:
+            pass
+        await asyncio.sleep(TYPING_REFRESH)
+
+
+async def _coalesce_and_answer(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Ждёт паузу COALESCE_WINDOW после последнего сообщения (но не больше
+    COALESCE_MAX_WAIT от первого), потом отвечает на всё разом одним вызовом модели.
+    Ход закрывается только когда чат свободен (COALESCE_LOCKS): сообщения,
+    пришедшие во время предыдущего ответа, попадают в этот же ход, а не обгоняют его.
+    """
+    pending = COALESCE_PENDING[chat_id]
+    typing = asyncio.create_task(_keep_typing(context.bot, chat_id))
     try:
-        answer = ask_gemini(history)
+        started = time.monotonic()
+        while True:
+            pending["wake"].clear()
+            left = min(COALESCE_WINDOW, started + COALESCE_MAX_WAIT - time.monotonic())
+            if left <= 0:
+                break
+            try:
+                await asyncio.wait_for(pending["wake"].wait(), left)
+            except asyncio.TimeoutError:
+                break
+        async with _chat_lock(chat_id):
+            if COALESCE_PENDING.get(chat_id) is pending:
+                COALESCE_PENDING.pop(chat_id)
+            texts = pending["texts"]
+            if len(texts) == 1 and not pending["local_tried"] and await funnel_try_local(pending["update"], context, texts[0]):
+                return
+            await answer_with_gemini(pending["update"], context, "\n".join(texts))
     except Exception as e:
-        err = str(e)
-        low = err.lower()
-        print("Gemini error:", err)
+        print("coalesced answer failed:", e)
+    finally:
+        typing.cancel()
+        if COALESCE_PENDING.get(chat_id) is pending:
+            COALESCE_PENDING.pop(chat_id)
 
-        if "429" in err or "quota" in low or "rate limit" in low:
-            GLOBAL_LIMIT["blocked_date"] = str(datetime.now(timezone.utc).date())
-            await update.message.reply_text("⚠️ Бесплатный лимит на сегодня исчерпан. Попробуйте завтра.")
-            return
 
+async def answer_with_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Gemini flow для одного хода (text может быть склейкой нескольких сообщений)."""
+    user = update.effective_user
+
+    name_form, niche_form, niche_db = await get_user_profile(int(user.id))
+
+    facts = build_user_facts(name_form, niche_form, niche_db)
+
+    history = context.user_data.get("history", [])
+    turn = sum(1 for h in history if h.get("role") == "user")
+    cache_key = response_cache_key(text, bool(niche_form), turn)
+    answer = await response_cache_get(cache_key) if cache_key else None
+
+    if answer is not None:
+        response_cache_record(hit=True)
+        await update.message.reply_text(answer)
+        await db_log_message(int(user.id), "out", answer)
+        _append_turn(context.user_data, text, answer)
+        return
+
+    # квота тратится только на реальный вызов модели (кэш-хиты бесплатны)
+    allowed, reason = await RATE_LIMITER.acquire(int(user.id))
+    if not allowed:
+        await update.message.reply_text(reason)
+        return
+
+    history.append({"role": "user", "parts": [{"text": text}]})
+    history, summary = compact_history(history, context.user_data.get("summary", ""))
+    context.user_data["history"] = history
+    context.user_data["summary"] = summary
+    system_extra = build_system_extra(facts, summary)
+
+    t0 = time.monotonic()
+    try:
+        if GEMINI_STREAMING:
+            answer = await reply_streaming(update, history, system_extra)
+        else:
+            answer = await ask_gemini(history, system_extra)
+    except GeminiUnavailableError as e:
+        # все ключи/модели упёрлись в лимит или брейкер — это минуты, а не сутки
+        print("Gemini unavailable:", e)
+        await update.message.reply_text(GEMINI_BUSY_TEXT)
+        return
+    except Exception as e:
+        print("Gemini error:", e)
         await update.message.reply_text("⚠️ Ошибка. Попробуйте ещё раз через минуту.")
         return
 
-    await update.message.reply_text(answer)
+    if cache_key:
+        response_cache_record(hit=False, gemini_seconds=time.monotonic() - t0)
+        await response_cache_put(cache_key, answer, personal=(name_form, niche_form, niche_db, user.first_name))
+
+    if not GEMINI_STREAMING:
+        await update.message.reply_text(answer)
     await db_log_message(int(user.id), "out", answer)
 
+    _append_turn(context.user_data, None, answer)
+
+
+def _append_turn(user_data: dict, user_text: str | None, answer: str):
+    # перечитываем user_data после await-ов: история могла измениться (/start, воронка)
+    history = list(user_data.get("history", []))
+    if user_text is not None:
+        history.append({"role": "user", "parts": [{"text": user_text}]})
     history.append({"role": "model", "parts": [{"text": answer}]})
-    context.user_data["history"] = history[-(MAX_TURNS * 2):]
+    history, summary = compact_history(history, user_data.get("summary", ""))
+    user_data["history"] = history
+    user_data["summary"] = summary
 
 
 # ============================================================
@@ -493,33 +3667,92 @@ async def health(request: web.Request) -> web.Response:
     return web.Response(text="ok")
 
 
+async def ready(request: web.Request) -> web.Response:
+    if APP_READY.is_set():
+        return web.json_response({"ok": True, "ready": True})
+    return web.json_response({"ok": False, "ready": False, "stage": STARTUP_STAGE}, status=503)
+
+
 async def version(request: web.Request) -> web.Response:
     return web.Response(text=f"build={BUILD_TAG}")
 
 
 async def webhook_handler(request: web.Request) -> web.Response:
     global tg_app
-    data = await request.json()
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401, text="unauthorized")
+
+    try:
+        data = await request.json()
+    except Exception:
+        return web.Response(status=400, text="bad json")
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        return web.Response(status=400, text="bad update")
+
+    WEBHOOK_STATS["received"] += 1
+    if _webhook_seen(data["update_id"]):
+        WEBHOOK_STATS["duplicates"] += 1
+        return web.Response(text="ok")
+
     update = Update.de_json(data, tg_app.bot)
-    await tg_app.process_update(update)
+    update_type = _update_type(data)
+    if WEBHOOK_FAST_ACK and WEBHOOK_QUEUES:
+        await enqueue_update(update, update_type)
+    else:
+        async with WEBHOOK_UPDATE_SECONDS.time(update_type):
+            await tg_app.process_update(update)
     return web.Response(text="ok")
 
 
+async def metrics(request: web.Request) -> web.Response:
+    if METRICS_TOKEN:
+        token = request.query.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if token != METRICS_TOKEN:
+            return web.Response(status=401, text="unauthorized")
+
+    if DB_POOL is not None:
+        size = DB_POOL.get_size()
+        DB_POOL_SIZE.set(size)
+        DB_POOL_IN_USE.set(size - DB_POOL.get_idle_size())
+    try:
+        RATE_REMAINING.set(await RATE_LIMITER.remaining())
+    except Exception as e:
+        print("metrics: quota read failed:", e)
+    for st in GEMINI_ROUTER.stats():
+        GEMINI_ROUTE_STATE.set(
+            {"closed": 0, "half_open": 1, "open": 2, "rate_limited": 3}[st["state"]], st["key"], st["model"]
+        )
+    WEBHOOK_QUEUE_DEPTH.set(sum(q.qsize() for q in WEBHOOK_QUEUES))
+    WEBHOOK_LAG.set(WEBHOOK_STATS["lag_last"])
+    for kind in ("hits", "misses", "stores"):
+        RESPONSE_CACHE_EVENTS.set(RESPONSE_CACHE_STATS[kind], kind)
+
+    lines: list[str] = []
+    for m in METRICS:
+        lines += m.render()
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain", charset="utf-8")
+
+
+async def webhook_stats(request: web.Request) -> web.Response:
+    token = request.headers.get("X-Task-Token") or request.query.get("token")
+    if not REPORT_TASK_TOKEN or token != REPORT_TASK_TOKEN:
+        return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+    return web.json_response({"ok": True, **webhook_queue_stats()})
+
+
 async def api_leads_miniapp(request: web.Request) -> web.Response:
     try:
         body = await request.json()
     except Exception:
         return web.json_response({"ok": False, "error": "Bad JSON"}, status=400)
 
-    init_data = body.get("initData") or ""
     form = body.get("form") or {}
 
     try:
-        parsed = verify_telegram_webapp_init_data(init_data, TOKEN)
+        user, credential = miniapp_auth(request, body)
     except Exception as e:
         return web.json_response({"ok": False, "error": f"initData invalid: {e}"}, status=401)
 
-    user = parsed.get("user") or {}
     tg_id = user.get("id")
     first_name = user.get("first_name") or ""
     username = user.get("username") or ""
@@ -531,32 +3764,6 @@ async def api_leads_miniapp(request: web.Request) -> web.Response:
     if not tg_id or not DB_POOL or tg_app is None:
         return web.json_response({"ok": False, "error": "No tg_id or DB/Bot not ready"}, status=500)
 
-    async with DB_POOL.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users (tg_id, first_name, username, business_niche, contact, last_seen)
-            VALUES ($1, $2, $3, NULLIF($4,''), NULLIF($5,''), now())
-            ON CONFLICT (tg_id) DO UPDATE SET
-              first_name = EXCLUDED.first_name,
-              username = EXCLUDED.username,
-              business_niche = COALESCE(users.business_niche, EXCLUDED.business_niche),
-              contact = COALESCE(users.contact, EXCLUDED.contact),
-              last_seen = now()
-        """, int(tg_id), first_name, username, niche, contact)
-
-        lead_id = await conn.fetchval("""
-            INSERT INTO leads (tg_id, source, name_from_form, niche_from_form, contact_from_form, payload)
-            VALUES ($1, 'miniapp', NULLIF($2,''), NULLIF($3,''), NULLIF($4,''), $5)
-            RETURNING id
-        """, int(tg_id), name, niche, contact, json.dumps(form))
-
-    await db_log_event(
-        event="miniapp_submit",
-        source="miniapp",
-        tg_id=int(tg_id),
-        lead_id=int(lead_id),
-        meta={"name": name, "niche": niche},
-    )
-
     final_name = (name or first_name or "друг").strip()
     final_niche = (niche or "—").strip()
 
@@ -566,12 +3773,102 @@ async def api_leads_miniapp(request: web.Request) -> web.Response:
         f"{POST_MINIAPP_TEXT}"
     )
 
+    # повторное нажатие с тем же initData и той же формой -> та же заявка
+    idem_key = hashlib.sha256(
+        (credential + "\n" + json.dumps(form, sort_keys=True, ensure_ascii=False)).encode("utf-8")
+    ).hexdigest()
+
+    # users + leads + lead_events + outbox + воронка: один запрос, одна транзакция
+    async with db_acquire() as conn:
+        row = await conn.fetchrow("""
+            WITH u AS (
+              INSERT INTO users (tg_id, first_name, username, business_niche, contact, last_seen)
+              VALUES ($1, $2, $3, NULLIF($4,''), NULLIF($5,''), now())
+              ON CONFLICT (tg_id) DO UPDATE SET
+                first_name = EXCLUDED.first_name,
+                username = EXCLUDED.username,
+                business_niche = COALESCE(users.business_niche, EXCLUDED.business_niche),
+                contact = COALESCE(users.contact, EXCLUDED.contact),
+                last_seen = now()
+              RETURNING tg_id
+            ),
+            l AS (
+              INSERT INTO leads (tg_id, source, name_from_form, niche_from_form, contact_from_form, payload, idempotency_key)
+              VALUES ($1, 'miniapp', NULLIF($6,''), NULLIF($4,''), NULLIF($5,''), $7, $8)
+              ON CONFLICT (idempotency_key) DO NOTHING
+              RETURNING id
+            ),
+            e AS (
+              INSERT INTO lead_events (tg_id, lead_id, event, source, meta)
+              SELECT $1, l.id, 'miniapp_submit', 'miniapp', $9::jsonb FROM l
+              RETURNING id
+            ),
+            o AS (
+              INSERT INTO outbox (chat_id, text, lead_id)
+              SELECT $1, $10, l.id FROM l
+              RETURNING id
+            ),
+            f AS (
+              INSERT INTO lead_funnel (tg_id, stage, updated_at)
+              SELECT $1, 'choose_service', now() FROM l
+              ON CONFLICT (tg_id) DO UPDATE SET stage = 'choose_service', updated_at = now()
+              RETURNING tg_id
+            ),
+            st AS (
+              INSERT INTO funnel_stages (tg_id, stage, reached_at)
+              SELECT $1, 'miniapp_submit', now() FROM l
+              ON CONFLICT (tg_id, stage) DO NOTHING
+              RETURNING stage
+            ),
+            d AS (
+              INSERT INTO funnel_daily (day, source, event, n)
+              SELECT (now() AT TIME ZONE 'UTC')::date, 'miniapp', 'miniapp_submit', 1 FROM l
+              UNION ALL
+              SELECT (now() AT TIME ZONE 'UTC')::date, '*', 'stage:miniapp_submit', 1 FROM st
+              ON CONFLICT (day, source, event) DO UPDATE SET n = funnel_daily.n + EXCLUDED.n
+              RETURNING 1
+            )
+            SELECT (SELECT id FROM l) AS lead_id,
+                   (SELECT id FROM leads WHERE idempotency_key = $8) AS existing_id
+        """, int(tg_id), first_name, username, niche, contact, name, json.dumps(form), idem_key,
+            json.dumps({"name": name, "niche": niche}), msg)
+        duplicate = row["lead_id"] is None
+        lead_id = row["existing_id"] if duplicate else row["lead_id"]
+        if duplicate and lead_id is None:
+            # параллельный двойной тап: чужая строка ещё не была видна снимку CTE,
+            # а к концу ON CONFLICT она уже закоммичена — новый запрос её видит
+            lead_id = await conn.fetchval("SELECT id FROM leads WHERE idempotency_key = $1", idem_key)
+
+    await publish_invalidation("lead", [int(tg_id)])
+
+    if not duplicate:
+        outbox_wakeup()
+
+    return web.json_response({
+        "ok": True,
+        "leadId": lead_id,
+        "duplicate": duplicate,
+        "sessionToken": issue_session_token(user, TOKEN),
+    })
+
+
+async def api_auth_miniapp(request: web.Request) -> web.Response:
+    """
+    initData -> сессионный токен для последующих /api/... вызовов.
+    """
+    try:
+        body = await request.json()
+    except Exception:
+        return web.json_response({"ok": False, "error": "Bad JSON"}, status=400)
+
     try:
-        await tg_app.bot.send_message(chat_id=int(tg_id), text=msg)
+        user, _ = miniapp_auth(request, body)
     except Exception as e:
-        print("send_message to user failed:", e)
+        return web.json_response({"ok": False, "error": f"initData invalid: {e}"}, status=401)
+    if not user.get("id"):
+        return web.json_response({"ok": False, "error": "No user in initData"}, status=401)
 
-    return web.json_response({"ok": True, "leadId": lead_id})
+    return web.json_response({"ok": True, "sessionToken": issue_session_token(user, TOKEN), "expiresIn": WEBAPP_SESSION_TTL})
 
 
 async def tasks_daily_report(request: web.Request) -> web.Response:
@@ -579,99 +3876,729 @@ async def tasks_daily_report(request: web.Request) -> web.Response:
     if not REPORT_TASK_TOKEN or token != REPORT_TASK_TOKEN:
         return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
 
-    await send_owner_report("day")
+    # по расписанию — закрытый вчерашний день: сегодняшний ещё не закончился
+    await send_owner_report(request.query.get("period") or "yesterday")
     return web.json_response({"ok": True})
 
 
+async def tasks_export(request: web.Request) -> web.StreamResponse:
+    """
+    GET /tasks/export?table=leads|events|messages&period=7d (или from=&to=) — CSV потоком.
+    """
+    token = request.headers.get("X-Task-Token") or request.query.get("token")
+    if not REPORT_TASK_TOKEN or token != REPORT_TASK_TOKEN:
+        return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+
+    table = request.query.get("table", "leads")
+    if table not in EXPORT_TABLES:
+        return web.json_response({"ok": False, "error": f"table: {', '.join(EXPORT_TABLES)}"}, status=400)
+    period = request.query.get("period") or "day"
+    if request.query.get("from"):
+        period = f"{request.query['from']} {request.query.get('to') or request.query['from']}"
+    try:
+        d_from, d_to = _report_range(period)
+    except ValueError:
+        return web.json_response({"ok": False, "error": "bad period"}, status=400)
+
+    resp = web.StreamResponse(headers={
+        "Content-Type": "text/csv; charset=utf-8",
+        "Content-Disposition": f'attachment; filename="{table}_{d_from.isoformat()}_{d_to.isoformat()}.csv"',
+    })
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    await resp.write("\ufeff".encode("utf-8"))
+    async for chunk in export_csv_chunks(table, d_from, d_to):
+        await resp.write(chunk)
+    await resp.write_eof()
+    return resp
+
+
+async def tasks_search(request: web.Request) -> web.Response:
+    """GET /tasks/search?q=...&page=1&pageSize=10 — тот же поиск, что /search, в JSON."""
+    token = request.headers.get("X-Task-Token") or request.query.get("token")
+    if not REPORT_TASK_TOKEN or token != REPORT_TASK_TOKEN:
+        return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+
+    query = (request.query.get("q") or "").strip()
+    if not query:
+        return web.json_response({"ok": False, "error": "q is required"}, status=400)
+    try:
+        page = max(1, int(request.query.get("page", "1")))
+        page_size = min(100, max(1, int(request.query.get("pageSize", str(SEARCH_PAGE_SIZE)))))
+    except ValueError:
+        return web.json_response({"ok": False, "error": "bad page"}, status=400)
+
+    total, truncated, rows = await search_conversations(query, page, page_size)
+    return web.json_response({
+        "ok": True,
+        "total": total,
+        "truncated": truncated,
+        "page": page,
+        "pageSize": page_size,
+        "results": [_search_row_dict(r) for r in rows],
+    })
+
+
 # ============================================================
-# ✅ MAIN
+# ✅ Schema migrations
 # ============================================================
-async def main_async():
-    global tg_app, DB_POOL
+async def _m_partitioned_logs(conn):
+    await ensure_partitioned_table(conn, "messages")
+    await ensure_partitioned_table(conn, "lead_events")
 
-    if not TOKEN:
-        raise RuntimeError("Missing TELEGRAM_TOKEN")
-    if not GOOGLE_API_KEY:
-        raise RuntimeError("Missing GOOGLE_API_KEY")
-    if not DATABASE_URL:
-        raise RuntimeError("Missing DATABASE_URL")
 
+async def _m_users_pk(conn):
+    # старые БД могли получить users без PK (только UNIQUE) — добавляем, если его нет
+    has_pk = await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'users'::regclass AND contype = 'p')"
+    )
+    if not has_pk:
+        await conn.execute("ALTER TABLE users ADD PRIMARY KEY (tg_id)")
+
+
+async def _create_index_concurrently(conn, name: str, ddl: str):
+    """
+    CREATE INDEX CONCURRENTLY не блокирует запись; невалидный остаток
+    от прерванной попытки сначала удаляем.
+    """
+    invalid = await conn.fetchval(
+        "SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = $1",
+        name,
+    )
+    if invalid:
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    await conn.execute(ddl)
+
+
+async def _create_partitioned_index(conn, table: str, name: str, suffix: str, spec: str):
+    """
+    На партиционированной таблице CONCURRENTLY нельзя: индекс ON ONLY на родителе,
+    каждая партиция — CONCURRENTLY отдельно и ATTACH. Новые партиции получают индекс сами.
+    """
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {spec}")
+    parts = await conn.fetch(
+        "SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = $1::regclass",
+        table,
+    )
+    for r in parts:
+        attached = await conn.fetchval(
+            """
+            SELECT EXISTS (
+              SELECT 1 FROM pg_inherits i
+              JOIN pg_index x ON x.indexrelid = i.inhrelid
+              JOIN pg_class t ON t.oid = x.indrelid
+              WHERE i.inhparent = $1::regclass AND t.relname = $2
+            )
+            """,
+            name, r["name"],
+        )
+        if attached:
+            continue
+        idx = f"{r['name']}_{suffix}"
+        await _create_index_concurrently(
+            conn, idx, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {idx} ON {r['name']} {spec}"
+        )
+        await conn.execute(f"ALTER INDEX {name} ATTACH PARTITION {idx}")
+
+
+async def _m_messages_search_index(conn):
+    await _create_partitioned_index(conn, "messages", "idx_messages_tsv", "tsv_idx", "USING gin (tsv)")
+
+
+async def _m_messages_created_index(conn):
+    # поиск: кандидаты — самые свежие совпадения; обратный проход по created_at
+    # по партициям от новой к старой останавливается, набрав SEARCH_MAX_HITS
+    await _create_partitioned_index(conn, "messages", "idx_messages_created", "created_idx", "(created_at DESC)")
+
+
+async def _m_leads_profile_index(conn):
+    # db_get_user_profile: WHERE tg_id=$1 AND source='miniapp' ORDER BY id DESC LIMIT 1 -> index-only scan
+    await _create_index_concurrently(conn, "idx_leads_tg_source_id", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_leads_tg_source_id
+        ON leads (tg_id, source, id DESC) INCLUDE (name_from_form, niche_from_form)
+    """)
+
+
+# (version, name, steps, transactional); шаг — SQL-строка или async fn(conn)
+MIGRATIONS = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+          tg_id BIGINT PRIMARY KEY,
+          first_name TEXT NULL,
+          username TEXT NULL,
+          business_niche TEXT NULL,
+          contact TEXT NULL,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          last_seen TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS leads (
+          id BIGSERIAL PRIMARY KEY,
+          tg_id BIGINT NULL,
+          source TEXT NOT NULL,
+          name_from_form TEXT NULL,
+          niche_from_form TEXT NULL,
+          contact_from_form TEXT NULL,
+          payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        _m_partitioned_logs,
+        "CREATE INDEX IF NOT EXISTS idx_messages_tg_id_created ON messages (tg_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_lead_events_tg_created ON lead_events (tg_id, created_at ASC)",
+        "CREATE INDEX IF NOT EXISTS idx_lead_events_created ON lead_events (created_at DESC)",
+    ], True),
+    (2, "leads idempotency + outbox", [
+        "ALTER TABLE leads ADD COLUMN IF NOT EXISTS idempotency_key TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_leads_idempotency_key ON leads (idempotency_key)",
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+          id BIGSERIAL PRIMARY KEY,
+          chat_id BIGINT NOT NULL,
+          text TEXT NOT NULL,
+          lead_id BIGINT NULL,
+          attempts INT NOT NULL DEFAULT 0,
+          next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          sent_at TIMESTAMPTZ NULL,
+          failed_at TIMESTAMPTZ NULL,
+          last_error TEXT NULL,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (next_attempt_at) WHERE sent_at IS NULL AND failed_at IS NULL
+        """,
+    ], True),
+    (3, "broadcasts", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+          id BIGSERIAL PRIMARY KEY,
+          text TEXT NOT NULL,
+          status TEXT NOT NULL DEFAULT 'new',
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          started_at TIMESTAMPTZ NULL,
+          finished_at TIMESTAMPTZ NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+          broadcast_id BIGINT NOT NULL,
+          tg_id BIGINT NOT NULL,
+          status TEXT NOT NULL,
+          error TEXT NULL,
+          updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          PRIMARY KEY (broadcast_id, tg_id)
+        )
+        """,
+    ], True),
+    (4, "funnel state + rollups", [
+        """
+        CREATE TABLE IF NOT EXISTS lead_funnel (
+          tg_id BIGINT PRIMARY KEY,
+          stage TEXT NOT NULL DEFAULT 'new',
+          service SMALLINT NULL,
+          budget TEXT NULL,
+          updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS funnel_daily (
+          day DATE NOT NULL,
+          source TEXT NOT NULL,
+          event TEXT NOT NULL,
+          n BIGINT NOT NULL DEFAULT 0,
+          PRIMARY KEY (day, source, event)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS funnel_stages (
+          tg_id BIGINT NOT NULL,
+          stage TEXT NOT NULL,
+          reached_at TIMESTAMPTZ NOT NULL,
+          PRIMARY KEY (tg_id, stage)
+        )
+        """,
+        # однократный backfill rollup из уже накопленных lead_events
+        """
+        WITH empty AS (SELECT NOT EXISTS (SELECT 1 FROM funnel_daily) AS yes)
+        INSERT INTO funnel_daily (day, source, event, n)
+        SELECT (created_at AT TIME ZONE 'UTC')::date, COALESCE(source, '-'), event, count(*)
+        FROM lead_events, empty
+        WHERE empty.yes
+        GROUP BY 1, 2, 3
+        """,
+        """
+        WITH empty AS (SELECT NOT EXISTS (SELECT 1 FROM funnel_stages) AS yes),
+        firsts AS (
+          INSERT INTO funnel_stages (tg_id, stage, reached_at)
+          SELECT tg_id, event, min(created_at)
+          FROM lead_events, empty
+          WHERE empty.yes AND tg_id IS NOT NULL
+            AND event IN ('start', 'miniapp_submit', 'message', 'budget')
+          GROUP BY tg_id, event
+          ON CONFLICT DO NOTHING
+          RETURNING stage, reached_at
+        )
+        INSERT INTO funnel_daily (day, source, event, n)
+        SELECT (reached_at AT TIME ZONE 'UTC')::date, '*', 'stage:' || stage, count(*)
+        FROM firsts
+        GROUP BY 1, 3
+        ON CONFLICT (day, source, event) DO UPDATE SET n = funnel_daily.n + EXCLUDED.n
+        """,
+    ], True),
+    (5, "caches, rate limits, conversations", [
+        """
+        CREATE TABLE IF NOT EXISTS gemini_cache (
+          key TEXT PRIMARY KEY,
+          answer TEXT NOT NULL,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+          key TEXT PRIMARY KEY,
+          tokens DOUBLE PRECISION NOT NULL,
+          updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+          tg_id BIGINT PRIMARY KEY,
+          data JSONB NOT NULL DEFAULT '{}'::jsonb,
+          updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    ], True),
+    (6, "users primary key", [_m_users_pk], True),
+    (7, "leads profile index", [_m_leads_profile_index], False),
+    (8, "messages search column", [
+        # STORED-колонка пересчитывается самим Postgres при COPY из лог-писателя
+        """
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('russian', coalesce(text, ''))) STORED
+        """,
+    ], True),
+    (9, "messages search index", [_m_messages_search_index], False),
+    (10, "messages created_at index", [_m_messages_created_index], False),
+]
+SCHEMA_HEAD = max(v for v, _, _, _ in MIGRATIONS)
+MIGRATIONS_LOCK_ID = 727_001  # pg_advisory_lock: один мигратор на все процессы
+
+
+async def _schema_version(conn) -> int:
+    try:
+        return int(await conn.fetchval("SELECT COALESCE(max(version), 0) FROM schema_migrations"))
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def run_migrations():
+    """
+    Если схема уже на HEAD — один SELECT и никакого DDL.
+    Иначе под advisory lock применяет недостающие миграции по порядку.
+    """
+    async with db_acquire() as conn:
+        if await _schema_version(conn) >= SCHEMA_HEAD:
+            return
+
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                  version INT PRIMARY KEY,
+                  name TEXT NOT NULL,
+                  applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            current = await _schema_version(conn)
+            for version, name, steps, transactional in MIGRATIONS:
+                if version <= current:
+                    continue
+                t0 = time.monotonic()
+                tx = conn.transaction() if transactional else None
+                if tx is not None:
+                    await tx.start()
+                try:
+                    for step in steps:
+                        if callable(step):
+                            await step(conn)
+                        else:
+                            await conn.execute(step)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name
+                    )
+                except BaseException as e:
+                    print(f"migration {version} ({name}) failed, rolled back:", repr(e), flush=True)
+                    if tx is not None:
+                        await tx.rollback()
+                    raise
+                if tx is not None:
+                    await tx.commit()
+                print(f"✅ migration {version} ({name}) applied in {time.monotonic() - t0:.2f}s", flush=True)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+
+
+# ============================================================
+# ✅ Multi-process front
+# ============================================================
+FRONT_SESSIONS: list[aiohttp.ClientSession] = []
+FRONT_PROCS: list[asyncio.subprocess.Process | None] = []
+FRONT_STOPPING = False
+FRONT_RR = 0
+FRONT_PROXY_HEADERS = (
+    "Content-Type", "Authorization", "Origin", "X-Task-Token", "X-Telegram-Bot-Api-Secret-Token",
+    "Access-Control-Request-Method", "Access-Control-Request-Headers",
+)
+
+
+def _worker_socket_path(index: int) -> str:
+    port = os.environ.get("PORT", "10000")
+    return os.path.join(WORKER_SOCKET_DIR, f"bot-worker-{port}-{index}.sock")
+
+
+def _raw_update_chat_id(data: dict) -> int:
+    """
+    chat_id из сырого апдейта без PTB: message.chat, callback_query.message.chat,
+    иначе from/user, иначе update_id.
+    """
+    for key, obj in data.items():
+        if key == "update_id" or not isinstance(obj, dict):
+            continue
+        for holder in (obj, obj.get("message")):
+            chat = holder.get("chat") if isinstance(holder, dict) else None
+            if isinstance(chat, dict) and isinstance(chat.get("id"), int):
+                return chat["id"]
+        sender = obj.get("from") or obj.get("user")
+        if isinstance(sender, dict) and isinstance(sender.get("id"), int):
+            return sender["id"]
+    return int(data.get("update_id") or 0)
+
+
+def _worker_for_chat(chat_id: int) -> int:
+    # перемешиваем id: внутри воркера чаты ещё раз шардируются по chat_id % WEBHOOK_WORKERS,
+    # и простой chat_id % N оставил бы часть очередей воркера пустыми
+    digest = hashlib.blake2b(str(chat_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % WORKER_PROCESSES
+
+
+async def _proxy_to_worker(request: web.Request, index: int, body: bytes | None = None) -> web.Response:
+    if body is None:
+        body = await request.read()
+    headers = {h: request.headers[h] for h in FRONT_PROXY_HEADERS if h in request.headers}
+    try:
+        async with FRONT_SESSIONS[index].request(
+            request.method, f"http://worker{request.path_qs}", data=body, headers=headers
+        ) as r:
+            payload = await r.read()
+            out = {k: v for k, v in r.headers.items() if k.startswith("Access-Control-") or k in ("Vary", "Retry-After")}
+            return web.Response(status=r.status, body=payload, headers=out, content_type=r.content_type, charset=r.charset)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"front: worker {index} unavailable:", e)
+        return web.json_response({"ok": False, "error": "worker unavailable"}, status=503, headers={"Retry-After": "1"})
+
+
+async def _stream_from_worker(request: web.Request, index: int) -> web.StreamResponse:
+    # большой CSV (/tasks/export): отдаём потоком, без буфера в памяти и без общего таймаута —
+    # обрывается только зависшее чтение
+    headers = {h: request.headers[h] for h in FRONT_PROXY_HEADERS if h in request.headers}
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+    resp = None
+    try:
+        async with FRONT_SESSIONS[index].get(f"http://worker{request.path_qs}", headers=headers, timeout=timeout) as r:
+            out = {k: v for k, v in r.headers.items() if k in ("Content-Type", "Content-Disposition")}
+            resp = web.StreamResponse(status=r.status, headers=out)
+            resp.enable_chunked_encoding()
+            await resp.prepare(request)
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                await resp.write(chunk)
+            await resp.write_eof()
+            return resp
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"front: worker {index} stream failed:", e)
+        if resp is not None:
+            # заголовки уже ушли — клиент увидит оборванный ответ
+            return resp
+        return web.json_response({"ok": False, "error": "worker unavailable"}, status=503, headers={"Retry-After": "1"})
+
+
+async def front_webhook(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401, text="unauthorized")
+    body = await request.read()
+    try:
+        data = json.loads(body)
+    except Exception:
+        return web.Response(status=400, text="bad json")
+    if not isinstance(data, dict):
+        return web.Response(status=400, text="bad update")
+    # один чат — всегда один воркер: user_data, очередь и дедуп апдейтов живут там
+    return await _proxy_to_worker(request, _worker_for_chat(_raw_update_chat_id(data)), body)
+
+
+async def front_api(request: web.Request) -> web.Response:
+    global FRONT_RR
+    # Mini App API без состояния в памяти — по кругу
+    FRONT_RR = (FRONT_RR + 1) % WORKER_PROCESSES
+    return await _proxy_to_worker(request, FRONT_RR)
+
+
+async def front_default(request: web.Request) -> web.Response:
+    # /metrics, /version, /tasks/*, /webhook/stats: ?worker=N, по умолчанию основной воркер
+    try:
+        index = int(request.query.get("worker", "0"))
+    except ValueError:
+        index = 0
+    if not 0 <= index < WORKER_PROCESSES:
+        return web.json_response({"ok": False, "error": "bad worker"}, status=400)
+    if request.path == "/tasks/export":
+        return await _stream_from_worker(request, index)
+    return await _proxy_to_worker(request, index)
+
+
+async def front_ready(request: web.Request) -> web.Response:
+    async def probe(i: int) -> bool:
+        try:
+            async with FRONT_SESSIONS[i].get("http://worker/ready") as r:
+                return r.status == 200
+        except Exception:
+            return False
+
+    states = await asyncio.gather(*(probe(i) for i in range(WORKER_PROCESSES)))
+    return web.json_response({"ok": all(states), "workers": list(states)}, status=200 if all(states) else 503)
+
+
+async def _supervise_worker(index: int):
+    """Держит воркер запущенным: упал — перезапускаем через секунду."""
+    env = {**os.environ, "WORKER_INDEX": str(index)}
+    while not FRONT_STOPPING:
+        proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        FRONT_PROCS[index] = proc
+        print(f"✅ worker {index} started (pid {proc.pid})", flush=True)
+        code = await proc.wait()
+        if FRONT_STOPPING:
+            return
+        print(f"worker {index} exited with {code}, restarting", flush=True)
+        await asyncio.sleep(1)
+
+
+async def front_main():
+    """
+    WORKER_PROCESSES > 1: этот процесс только принимает HTTP и раздаёт его воркерам
+    (тот же bot.py с WORKER_INDEX) по unix-сокетам.
+    """
+    global FRONT_STOPPING
+    FRONT_PROCS[:] = [None] * WORKER_PROCESSES
+    FRONT_SESSIONS[:] = [
+        aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=_worker_socket_path(i), limit=0),
+            timeout=aiohttp.ClientTimeout(total=60),
+        )
+        for i in range(WORKER_PROCESSES)
+    ]
+
+    port = int(os.environ.get("PORT", "10000"))
+    web_app = web.Application()
+    web_app.router.add_get("/", health)
+    web_app.router.add_get("/health", health)
+    web_app.router.add_get("/ready", front_ready)
+    web_app.router.add_post("/webhook", front_webhook)
+    web_app.router.add_route("*", "/api/{tail:.*}", front_api)
+    web_app.router.add_route("*", "/{tail:.*}", front_default)
+
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    print(f"✅ Front up on :{port}, {WORKER_PROCESSES} workers", flush=True)
+
+    supervisors = [asyncio.create_task(_supervise_worker(i)) for i in range(WORKER_PROCESSES)]
+
+    stop_event = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    try:
+        await stop_event.wait()
+    finally:
+        FRONT_STOPPING = True
+        await runner.cleanup()
+        # воркеры штатно дописывают логи и persistence по SIGTERM
+        for proc in FRONT_PROCS:
+            if proc is not None and proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+        for proc in FRONT_PROCS:
+            if proc is None:
+                continue
+            try:
+                await asyncio.wait_for(proc.wait(), 25)
+            except asyncio.TimeoutError:
+                proc.kill()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        for session in FRONT_SESSIONS:
+            await session.close()
+
+
+# ============================================================
+# ✅ MAIN
+# ============================================================
+async def _init_db():
+    global DB_POOL, STARTUP_STAGE
     DB_POOL = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
     print("✅ DB pool ready", flush=True)
 
-    async with DB_POOL.acquire() as conn:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-              id BIGSERIAL PRIMARY KEY,
-              tg_id BIGINT NOT NULL,
-              direction TEXT NOT NULL,
-              text TEXT NOT NULL,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT now()
-            );
-        """)
-        await conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_messages_tg_id_created
-            ON messages (tg_id, created_at DESC);
-        """)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS lead_events (
-              id BIGSERIAL PRIMARY KEY,
-              tg_id BIGINT NULL,
-              lead_id BIGINT NULL,
-              event TEXT NOT NULL,
-              source TEXT NOT NULL,
-              meta JSONB NOT NULL DEFAULT '{}'::jsonb,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT now()
-            );
-        """)
-        await conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_lead_events_tg_created
-            ON lead_events (tg_id, created_at ASC);
-        """)
-        await conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_lead_events_created
-            ON lead_events (created_at DESC);
-        """)
-
-    tg_app = Application.builder().token(TOKEN).build()
+    STARTUP_STAGE = "migrations"
+    await run_migrations()
+
+    if RATE_LIMIT_BACKEND == "postgres":
+        RATE_LIMITER.store = PgBucketStore()
+
+
+async def _init_bot():
+    global tg_app
+    persistence = PgConversationPersistence(update_interval=PERSISTENCE_UPDATE_INTERVAL)
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .persistence(persistence)
+        .request(InstrumentedRequest(connection_pool_size=256))
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    tg_app = builder.build()
     tg_app.add_handler(CommandHandler("start", start))
     tg_app.add_handler(CommandHandler("report", report))
     tg_app.add_handler(CommandHandler("forget", forget_cmd))
+    tg_app.add_handler(CommandHandler("broadcast", broadcast_cmd))
+    tg_app.add_handler(CommandHandler("export", export_cmd))
+    tg_app.add_handler(CommandHandler("search", search_cmd))
     tg_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+    # getMe; persistence при старте в БД не ходит, так что можно параллельно с _init_db
     await tg_app.initialize()
-    await tg_app.start()
 
+
+async def ensure_webhook(url: str):
+    """
+    Не трогаем webhook, если он уже указывает на нас: повторный setWebhook не нужен,
+    а drop_pending_updates выбросил бы сообщения, пришедшие во время рестарта.
+    """
+    info = await tg_app.bot.get_webhook_info()
+    if info.url == url and not WEBHOOK_FORCE_RESET:
+        print(f"✅ Webhook already set ({info.pending_update_count} pending)", flush=True)
+        return
+    await tg_app.bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
+    print(f"✅ Webhook set (was: {info.url or '-'})", flush=True)
+
+
+async def main_async():
+    global STARTUP_STAGE
+    t_boot = time.monotonic()
+
+    if not TOKEN:
+        raise RuntimeError("Missing TELEGRAM_TOKEN")
+    if not GEMINI_API_KEYS:
+        raise RuntimeError("Missing GOOGLE_API_KEY (or GEMINI_API_KEYS)")
+    if not DATABASE_URL:
+        raise RuntimeError("Missing DATABASE_URL")
+
+    # 1) сначала HTTP: Render видит живой порт и /health сразу после деплоя
     port = int(os.environ.get("PORT", "10000"))
-    web_app = web.Application(middlewares=[cors_middleware])
+    web_app = web.Application(middlewares=[metrics_middleware, cors_middleware, readiness_middleware])
 
     web_app.router.add_get("/", health)
     web_app.router.add_get("/health", health)
+    web_app.router.add_get("/ready", ready)
     web_app.router.add_get("/version", version)
+    web_app.router.add_get("/metrics", metrics)
 
     web_app.router.add_post("/webhook", webhook_handler)
     web_app.router.add_post("/api/leads/miniapp", api_leads_miniapp)
+    web_app.router.add_post("/api/auth/miniapp", api_auth_miniapp)
     web_app.router.add_get("/tasks/daily_report", tasks_daily_report)
+    web_app.router.add_get("/tasks/export", tasks_export)
+    web_app.router.add_get("/tasks/search", tasks_search)
+    web_app.router.add_get("/webhook/stats", webhook_stats)
 
     runner = web.AppRunner(web_app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    if WORKER_INDEX is not None:
+        # воркер multi-process режима: HTTP только от front-процесса, через unix-сокет
+        site = web.UnixSite(runner, _worker_socket_path(WORKER_INDEX))
+    else:
+        site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
+    print(f"✅ HTTP up on {site.name} in {time.monotonic() - t_boot:.2f}s (/health)", flush=True)
 
+    # 2) БД + миграции и Bot API (getMe) — параллельно
+    STARTUP_STAGE = "init"
+    await asyncio.gather(_init_db(), _init_bot())
+
+    STARTUP_STAGE = "start"
+    await tg_app.start()
+
+    _get_http_session()
+    start_log_writer()
+    if WEBHOOK_FAST_ACK:
+        start_webhook_workers()
+    start_outbox_sender()
+    start_context_cache()
+    start_rate_sweeper()
+    await start_invalidation_listener()
+    if IS_PRIMARY:
+        start_db_maintenance()
+    await resume_interrupted_broadcasts()
+
+    STARTUP_STAGE = "ready"
+    APP_READY.set()
+    print(f"✅ Ready in {time.monotonic() - t_boot:.2f}s", flush=True)
+
+    # 3) webhook — уже на готовый сервер и без потери накопившихся апдейтов
     webhook_url = f"{BASE_URL}/webhook"
-    await tg_app.bot.delete_webhook(drop_pending_updates=True)
-    await tg_app.bot.set_webhook(url=webhook_url)
+    if IS_PRIMARY:
+        await ensure_webhook(webhook_url)
 
     print(f"✅ Bot started (WEBHOOK) on {webhook_url}", flush=True)
     print("✅ /version ready", flush=True)
     print("✅ /api/leads/miniapp ready", flush=True)
     print("✅ /tasks/daily_report ready", flush=True)
 
-    await asyncio.Event().wait()
+    # Render шлёт SIGTERM при редеплое — выходим штатно, дописав очередь логов
+    stop_event = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await stop_webhook_workers()
+        await stop_outbox_sender()
+        await stop_context_cache()
+        await stop_db_maintenance()
+        await stop_broadcast()
+        await stop_invalidation_listener()
+        # stop/shutdown -> PTB дописывает user_data в persistence и вызывает flush()
+        await tg_app.stop()
+        await tg_app.shutdown()
+        await stop_rate_sweeper()
+        await RATE_LIMITER.release_all()
+        await stop_log_writer()
+        await close_http_session()
 
 
 def main():
-    asyncio.run(main_async())
+    if MULTI_PROCESS and WORKER_INDEX is None:
+        asyncio.run(front_main())
+    else:
+        asyncio.run(main_async())
 
 
 if __name__ == "__main__":
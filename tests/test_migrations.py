@@ -0,0 +1,113 @@
+"""
+Цепочка MIGRATIONS на снимке исходной (до миграций) схемы с данными.
+Нужен живой Postgres: TEST_DATABASE_URL=postgresql://... python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_TOKEN", "test")
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+asyncpg = pytest.importorskip("asyncpg")
+import bot  # noqa: E402
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+SCHEMA = "test_migrations"
+
+# схема и данные в том виде, в каком их оставляла версия бота до MIGRATIONS
+BASELINE = """
+    CREATE TABLE users (
+      tg_id BIGINT PRIMARY KEY,
+      first_name TEXT NULL,
+      username TEXT NULL,
+      business_niche TEXT NULL,
+      contact TEXT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+      last_seen TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE TABLE leads (
+      id BIGSERIAL PRIMARY KEY,
+      tg_id BIGINT NULL,
+      source TEXT NOT NULL,
+      name_from_form TEXT NULL,
+      niche_from_form TEXT NULL,
+      contact_from_form TEXT NULL,
+      payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE TABLE messages (
+      id BIGSERIAL PRIMARY KEY,
+      tg_id BIGINT NOT NULL,
+      direction TEXT NOT NULL,
+      text TEXT NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX idx_messages_tg_id_created ON messages (tg_id, created_at DESC);
+    CREATE TABLE lead_events (
+      id BIGSERIAL PRIMARY KEY,
+      tg_id BIGINT NULL,
+      lead_id BIGINT NULL,
+      event TEXT NOT NULL,
+      source TEXT NOT NULL,
+      meta JSONB NOT NULL DEFAULT '{}'::jsonb,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX idx_lead_events_tg_created ON lead_events (tg_id, created_at ASC);
+    CREATE INDEX idx_lead_events_created ON lead_events (created_at DESC);
+
+    INSERT INTO users (tg_id, first_name) SELECT g, 'user ' || g FROM generate_series(1, 20) g;
+    INSERT INTO leads (tg_id, source, niche_from_form, created_at)
+      SELECT g, 'miniapp', 'кофейня', now() - g * interval '9 days' FROM generate_series(1, 20) g;
+    INSERT INTO messages (tg_id, direction, text, created_at)
+      SELECT 1 + g % 20, CASE WHEN g % 2 = 0 THEN 'in' ELSE 'out' END, 'сколько стоит реклама ' || g,
+             now() - g * interval '7 hours'
+      FROM generate_series(1, 1500) g;
+    INSERT INTO lead_events (tg_id, event, source, created_at)
+      SELECT 1 + g % 20, (ARRAY['start', 'miniapp_submit', 'service_selected', 'budget'])[1 + g % 4], 'bot',
+             now() - g * interval '11 hours'
+      FROM generate_series(1, 800) g;
+"""
+
+
+def test_migrations_on_baseline_snapshot():
+    async def run():
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await admin.execute(f"CREATE SCHEMA {SCHEMA}")
+        await admin.execute(f"SET search_path TO {SCHEMA}")
+        await admin.execute(BASELINE)
+        bot.DB_POOL = await asyncpg.create_pool(
+            TEST_DATABASE_URL, min_size=1, max_size=2, server_settings={"search_path": SCHEMA}
+        )
+        try:
+            await bot.run_migrations()
+            async with bot.DB_POOL.acquire() as conn:
+                assert await conn.fetchval("SELECT max(version) FROM schema_migrations") == bot.SCHEMA_HEAD
+                applied = await conn.fetch("SELECT version, applied_at FROM schema_migrations ORDER BY version")
+                for table in ("messages", "lead_events"):
+                    relkind = await conn.fetchval(f"SELECT relkind::text FROM pg_class WHERE oid = '{table}'::regclass")
+                    assert relkind == "p"
+                assert await conn.fetchval("SELECT count(*) FROM messages") == 1500
+                assert await conn.fetchval("SELECT count(*) FROM lead_events") == 800
+                assert await conn.fetchval("SELECT count(*) FROM leads") == 20
+                assert await conn.fetchval("SELECT count(*) FROM users") == 20
+
+            # второй прогон (рестарт) — без DDL и без новых записей в schema_migrations
+            await bot.run_migrations()
+            async with bot.DB_POOL.acquire() as conn:
+                assert await conn.fetch("SELECT version, applied_at FROM schema_migrations ORDER BY version") == applied
+                total, _truncated, rows = await bot.search_conversations("стоит")
+                assert total == 20 and rows
+        finally:
+            await bot.DB_POOL.close()
+            bot.DB_POOL = None
+            await admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            await admin.close()
+
+    asyncio.run(run())
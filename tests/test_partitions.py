@@ -0,0 +1,78 @@
+"""
+Перевод старых (обычных) таблиц логов на помесячные партиции.
+Нужен живой Postgres: TEST_DATABASE_URL=postgresql://... python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_TOKEN", "test")
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+asyncpg = pytest.importorskip("asyncpg")
+import bot  # noqa: E402
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+LEGACY_MESSAGES = """
+    CREATE TABLE messages (
+      id BIGSERIAL PRIMARY KEY,
+      tg_id BIGINT NOT NULL,
+      direction TEXT NOT NULL,
+      text TEXT NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX idx_messages_tg_id_created ON messages (tg_id, created_at DESC);
+"""
+
+
+async def _fresh_schema(conn):
+    # отдельная схема на тест: не трогаем то, что уже лежит в базе
+    await conn.execute("DROP SCHEMA IF EXISTS test_partitions CASCADE")
+    await conn.execute("CREATE SCHEMA test_partitions")
+    await conn.execute("SET search_path TO test_partitions")
+
+
+def test_converts_populated_legacy_table():
+    async def run():
+        conn = await asyncpg.connect(TEST_DATABASE_URL)
+        try:
+            await _fresh_schema(conn)
+            await conn.execute(LEGACY_MESSAGES)
+            now = datetime.now(timezone.utc)
+            rows = [(i % 7, "in", f"text {i}", now - timedelta(days=i * 3)) for i in range(200)]
+            await conn.executemany(
+                "INSERT INTO messages (tg_id, direction, text, created_at) VALUES ($1, $2, $3, $4)", rows
+            )
+            max_id = await conn.fetchval("SELECT max(id) FROM messages")
+
+            await bot.ensure_partitioned_table(conn, "messages")
+
+            relkind = await conn.fetchval("SELECT relkind::text FROM pg_class WHERE oid = 'messages'::regclass")
+            assert relkind == "p"
+            assert await conn.fetchval("SELECT count(*) FROM messages") == len(rows)
+            assert await conn.fetchval("SELECT count(*) FROM messages_default") == 0
+            assert await conn.fetchval("SELECT to_regclass('messages_legacy')") is None
+            months = {(r[3].year, r[3].month) for r in rows}
+            parts = await conn.fetchval(
+                "SELECT count(*) FROM pg_inherits WHERE inhparent = 'messages'::regclass"
+            )
+            assert parts >= len(months) + 1
+            new_id = await conn.fetchval(
+                "INSERT INTO messages (tg_id, direction, text) VALUES (1, 'in', 'new') RETURNING id"
+            )
+            assert new_id > max_id
+
+            # повторный вызов на уже партиционированной таблице — ничего не делает
+            await bot.ensure_partitioned_table(conn, "messages")
+            assert await conn.fetchval("SELECT count(*) FROM messages") == len(rows) + 1
+        finally:
+            await conn.execute("DROP SCHEMA IF EXISTS test_partitions CASCADE")
+            await conn.close()
+
+    asyncio.run(run())